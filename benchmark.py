@@ -0,0 +1,281 @@
+# Benchmark of the combine step on synthetic data.
+# The data is generated from `songs.json`, so the songs and the played songs follow the real distribution.
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import time
+
+import combine
+
+# constant user attributes, like the udacity sample data has them
+FIRST_NAMES = ["Lily", "Jacob", "Tegan", "Kate", "Chloe", "Aleena", "Mohammad", "Ryan", "Jayden", "Matthew"]
+LAST_NAMES = ["Koch", "Klein", "Levine", "Harrell", "Cuevas", "Kirby", "Rodriguez", "Smith", "Graves", "Jones"]
+LOCATIONS = ["San Francisco-Oakland-Hayward, CA", "Tampa-St. Petersburg-Clearwater, FL", "Portland-South Portland, ME",
+             "Lansing-East Lansing, MI", "Waterloo-Cedar Falls, IA", "Chicago-Naperville-Elgin, IL-IN-WI"]
+USER_AGENT = "\"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36\""
+# share of events that are not a played song, like `Home` or `Logout`, in the sample data about 15%
+OTHER_PAGES = ["Home", "Logout", "Settings", "About", "Help", "Upgrade"]
+
+
+def load_seed_songs(path="songs.json"):
+    """
+    :param path: the combined songs, as written by combine.py
+    :return: list of song dicts
+    """
+    with open(path, 'rt', encoding='utf-8') as song_reader:
+        return [json.loads(line) for line in song_reader]
+
+
+def generate_song_data(target_dir, count, seed_songs, rng):
+    """
+    Write `count` song files in the layout of the udacity bucket, like `song_data/A/B/C/TRABCXX128F4286B86.json`.
+    Songs are sampled from `seed_songs`, with a new song and track id so every file is unique.
+    :param target_dir: the directory, where `song_data` is created
+    :param count: number of song files
+    :param seed_songs: the songs to sample from
+    :param rng: the random.Random to use
+    :return: the number of written bytes
+    """
+    written = 0
+    for index in range(count):
+        song = dict(rng.choice(seed_songs))
+        track_id = f"TR{''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(3))}{index:013d}"
+        song["song_id"] = f"SO{index:016d}"
+        song_dir = os.path.join(target_dir, "song_data", track_id[2], track_id[3], track_id[4])
+        os.makedirs(song_dir, exist_ok=True)
+        payload = json.dumps(song)
+        with open(os.path.join(song_dir, track_id + ".json"), 'wt', encoding='utf-8') as song_writer:
+            song_writer.write(payload)
+        written += len(payload)
+    return written
+
+
+def generate_event(rng, seed_songs, ts, user_id, session_id, item_in_session):
+    """
+    Generate a single log event.
+    :return: the event dict, with the keys of the udacity log data
+    """
+    user = int(user_id)
+    event = {
+        "artist": None,
+        "auth": "Logged In",
+        "firstName": FIRST_NAMES[user % len(FIRST_NAMES)],
+        "gender": "MF"[user % 2],
+        "itemInSession": item_in_session,
+        "lastName": LAST_NAMES[user % len(LAST_NAMES)],
+        "length": None,
+        "level": rng.choice(["free", "paid"]),
+        "location": LOCATIONS[user % len(LOCATIONS)],
+        "method": "GET",
+        "page": rng.choice(OTHER_PAGES),
+        "registration": 1.540919166796E12 + user * 1000,
+        "sessionId": session_id,
+        "song": None,
+        "status": 200,
+        "ts": ts,
+        "userAgent": USER_AGENT,
+        "userId": user_id,
+    }
+    if rng.random() < 0.85:
+        song = rng.choice(seed_songs)
+        event.update({"artist": song["artist_name"], "song": song["title"], "length": song["duration"],
+                      "page": "NextSong", "method": "PUT"})
+    return event
+
+
+def generate_log_data(target_dir, days, events_per_day, seed_songs, rng, start=datetime.date(2018, 11, 1)):
+    """
+    Write one log file per day in the layout of the udacity bucket, like `log_data/2018/11/2018-11-01-events.json`.
+    :param target_dir: the directory, where `log_data` is created
+    :param days: number of days, one file per day
+    :param events_per_day: number of events per file
+    :param seed_songs: the songs that are played
+    :param rng: the random.Random to use
+    :param start: the date of the first file
+    :return: the number of written bytes
+    """
+    written = 0
+    for day in range(days):
+        date = start + datetime.timedelta(days=day)
+        log_dir = os.path.join(target_dir, "log_data", f"{date.year}", f"{date.month:02d}")
+        os.makedirs(log_dir, exist_ok=True)
+        day_start_ms = int(datetime.datetime(date.year, date.month, date.day).timestamp() * 1000)
+        with open(os.path.join(log_dir, f"{date.isoformat()}-events.json"), 'wt', encoding='utf-8') as log_writer:
+            for index in range(events_per_day):
+                ts = day_start_ms + index * (86400000 // max(1, events_per_day))
+                event = generate_event(rng, seed_songs, ts, str(rng.randint(1, 100)), rng.randint(1, 1000), index % 100)
+                line = json.dumps(event, separators=(",", ":")) + "\n"
+                log_writer.write(line)
+                written += len(line)
+    return written
+
+
+def run_case(data_dir, combine_function, source, kwargs, result_queue):
+    """
+    Run one combine call in a fresh interpreter, so the peak memory belongs to this case only.
+    :param data_dir: the directory with the generated data, the output is written there
+    :param combine_function: `combine.combine_events` or `combine.combine_songs`
+    :param source: the source directory below `data_dir`, `log_data` or `song_data`
+    :param kwargs: keyword arguments of the combine function
+    :param result_queue: the queue receiving (seconds, peak rss in kb, peak rss of the worker processes in kb)
+    :returns: None
+    """
+    os.chdir(data_dir)
+    start = time.perf_counter()
+    combine_function(os.path.join(".", source), **kwargs)
+    seconds = time.perf_counter() - start
+    result_queue.put((
+        seconds,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    ))
+
+
+def measure(data_dir, name, combine_function, source, kwargs, output, input_bytes, records):
+    """
+    Time a combine call and collect its throughput and peak memory.
+    :param data_dir: the directory with the generated data
+    :param name: the name of the case in the results
+    :param combine_function: `combine.combine_events` or `combine.combine_songs`
+    :param source: the source directory below `data_dir`, `log_data` or `song_data`
+    :param kwargs: keyword arguments of the combine function
+    :param output: the files and directories written by the case, removed before and after the run
+    :param input_bytes: the size of the generated source files
+    :param records: the number of generated records
+    :return: dict with the result of the case
+    """
+    remove_outputs(data_dir, output)
+    # a forked case would inherit the memory of the seed songs and count it into its peak rss
+    context = multiprocessing.get_context("spawn")
+    result_queue = context.Queue()
+    process = context.Process(target=run_case, args=(data_dir, combine_function, source, kwargs, result_queue))
+    process.start()
+    # the result is tiny, so joining before reading the queue can not block
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Benchmark case '{name}' failed with exit code {process.exitcode}")
+    seconds, peak_rss_kb, peak_worker_rss_kb = result_queue.get()
+    remove_outputs(data_dir, output)
+
+    result = {
+        "name": name,
+        "kwargs": {key: value for key, value in kwargs.items() if key != "sharding"},
+        "seconds": round(seconds, 4),
+        "records": records,
+        "input_mb": round(input_bytes / 1024 / 1024, 2),
+        "records_per_second": round(records / seconds) if seconds > 0 else None,
+        "mb_per_second": round(input_bytes / 1024 / 1024 / seconds, 2) if seconds > 0 else None,
+        "peak_rss_mb": round(peak_rss_kb / 1024, 1),
+        "peak_worker_rss_mb": round(peak_worker_rss_kb / 1024, 1),
+    }
+    print(f"{name:40s} {result['seconds']:8.3f}s {result['mb_per_second']:8.2f} MB/s {result['peak_rss_mb']:8.1f} MB peak")
+    return result
+
+
+def remove_outputs(data_dir, output):
+    """
+    :param data_dir: the directory with the generated data
+    :param output: relative paths of files and directories to remove
+    :returns: None
+    """
+    for path in output:
+        path = os.path.join(data_dir, path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def git_revision():
+    """
+    :return: the current git commit, so results can be matched to the code, or None outside of a checkout
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], encoding='utf8',
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def save_results(run, path):
+    """
+    Append the run to the results file, which holds a json list of all runs.
+    :param run: the results of this run
+    :param path: the results file
+    :returns: None
+    """
+    runs = []
+    if os.path.exists(path):
+        with open(path, 'rt') as results_reader:
+            runs = json.load(results_reader)
+    runs.append(run)
+    with open(path, 'wt') as results_writer:
+        json.dump(runs, results_writer, indent=1)
+
+
+def parse_arguments():
+    """
+    Parse the command line options of the benchmark.
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the combine step on synthetic data.")
+    parser.add_argument("--days", type=int, default=30, help="number of log files (default: 30)")
+    parser.add_argument("--events-per-day", type=int, default=300, help="number of events per log file (default: 300)")
+    parser.add_argument("--songs", type=int, default=14896, help="number of song files (default: 14896)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count()],
+                        help="worker counts to benchmark (default: 1 and all cores)")
+    parser.add_argument("--codecs", nargs="+", default=["json", "auto", "splice"],
+                        help="json codecs to benchmark for the events (default: json auto splice)")
+    parser.add_argument("--seed-songs", default="songs.json",
+                        help="combined songs the generated data is sampled from (default: songs.json)")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the data generator (default: 42)")
+    parser.add_argument("--data-dir", default="benchmark_data", help="where the data is generated (default: benchmark_data)")
+    parser.add_argument("--results", default="benchmark-results.json",
+                        help="json file the results are appended to (default: benchmark-results.json)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    data_dir = os.path.abspath(args.data_dir)
+    rng = random.Random(args.seed)
+    seed_songs = load_seed_songs(args.seed_songs)
+
+    print(f"Generating {args.days} days with {args.events_per_day} events and {args.songs} songs in {data_dir}")
+    shutil.rmtree(data_dir, ignore_errors=True)
+    log_bytes = generate_log_data(data_dir, args.days, args.events_per_day, seed_songs, rng)
+    song_bytes = generate_song_data(data_dir, args.songs, seed_songs, rng)
+    events = args.days * args.events_per_day
+
+    cases = []
+    for workers in sorted(set(args.workers)):
+        for codec in args.codecs:
+            cases.append(measure(data_dir, f"events workers={workers} codec={codec}", combine.combine_events, "log_data",
+                                 {"workers": workers, "codec": codec}, ["events.json"], log_bytes, events))
+        cases.append(measure(data_dir, f"songs workers={workers}", combine.combine_songs, "song_data",
+                             {"workers": workers}, ["songs.json"], song_bytes, args.songs))
+    cases.append(measure(data_dir, "events sharded gzip", combine.combine_events, "log_data",
+                         {"sharding": combine.ShardSettings()}, ["events", "events.manifest"], log_bytes, events))
+
+    run = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "scale": {"days": args.days, "events_per_day": args.events_per_day, "songs": args.songs, "seed": args.seed},
+        "cases": cases,
+    }
+    save_results(run, args.results)
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,1178 @@
+import argparse
+import functools
 import glob
+import gzip
+import hashlib
+import io
+import itertools
 import json
+import math
+import multiprocessing
 import os
+import shutil
+from decimal import Decimal
+from typing import NamedTuple
 
+from event_record import TYPED_KEYS, EventRecord
+from json_codec import CODEC_FACTORIES, event_date_suffix, get_codec, splice_fields
+from s3_transfer import S3Object, S3Source, TransferSettings, create_client, upload
 
-def combine_events(base_path):
+# number of serialized records collected before they are flushed to disk in one write call
+WRITE_BUFFER_SIZE = 10000
+# number of files handed to a worker process at once, the song files are tiny
+PARALLEL_CHUNK_SIZE = 64
+# file extension of a shard per compression, redshift detects nothing by itself, see `COPY ... GZIP/ZSTD`
+SHARD_EXTENSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+# the files and directories written per `--output`, that `--upload` copies to s3
+OUTPUT_PATHS = {
+    "single": ["events.json", "songs.json"],
+    "sharded": ["events", "events.manifest", "songs", "songs.manifest"],
+    "parquet": ["events_parquet", "songs_parquet"],
+    "partitioned": ["events_partitioned", "songs", "songs.manifest"],
+}
+
+
+# columns of the staging tables in `sql_queries.py`, in the same order as in the DDL,
+# as redshift maps parquet columns by position.
+# Each column is described by (column name, json key, type).
+EVENT_COLUMNS = [
+    ("artist", "artist", "string"),
+    ("auth", "auth", "string"),
+    ("firstname", "firstName", "string"),
+    ("gender", "gender", "string"),
+    ("iteminsession", "itemInSession", "int32"),
+    ("lastname", "lastName", "string"),
+    ("length", "length", "decimal(10,5)"),
+    ("level", "level", "string"),
+    ("location", "location", "string"),
+    ("method", "method", "string"),
+    ("page", "page", "string"),
+    ("registration", "registration", "int64"),
+    ("sessionid", "sessionId", "int32"),
+    ("song", "song", "string"),
+    ("status", "status", "int32"),
+    ("ts", "ts", "int64"),
+    ("useragent", "userAgent", "string"),
+    ("userid", "userId", "string"),
+]
+SONG_COLUMNS = [
+    ("song_id", "song_id", "string"),
+    ("num_songs", "num_songs", "int32"),
+    ("title", "title", "string"),
+    ("artist_name", "artist_name", "string"),
+    ("artist_latitude", "artist_latitude", "decimal(10,5)"),
+    ("year", "year", "int32"),
+    ("duration", "duration", "decimal(10,5)"),
+    ("artist_id", "artist_id", "string"),
+    ("artist_longitude", "artist_longitude", "decimal(10,5)"),
+    ("artist_location", "artist_location", "string"),
+]
+# compression codec inside the parquet files per --compression
+PARQUET_COMPRESSION = {"none": "none", "gzip": "gzip", "zstd": "zstd"}
+# columns without which a record is rejected by the validation, the keys of the star schema are derived from them
+EVENT_REQUIRED_COLUMNS = ["ts"]
+SONG_REQUIRED_COLUMNS = ["song_id", "artist_id"]
+# the staging tables store strings as VARCHAR(255), longer values fail the COPY
+MAX_STRING_BYTES = 255
+INTEGER_RANGES = {"int32": (-2 ** 31, 2 ** 31 - 1), "int64": (-2 ** 63, 2 ** 63 - 1)}
+
+
+class ShardSettings(NamedTuple):
     """
-    This combines all log events from the local copy of the udacity s3 bucket
-    and writes it out as one single file.
+    How the combined output is split for a parallel COPY.
+    Redshift loads one file per slice at a time,
+    so the number of shards is always a multiple of the slice count.
+    """
+    # uncompressed bytes per shard, aws recommends 1 MB to 1 GB after compression
+    target_size: int = 128 * 1024 * 1024
+    # number of slices of the cluster, a dc2.large node has 2
+    slices: int = 2
+    # one of SHARD_EXTENSIONS
+    compression: str = "gzip"
+    # s3 location where the shard directory is uploaded to, used for the COPY manifest
+    s3_prefix: str = ""
 
-    This improves the COPY execution on redshift a lot.
+
+class ValidationSettings(NamedTuple):
+    """
+    How the records are validated while they are combined.
+    """
+    # write the invalid records to `<name>.quarantine.json` instead of the output
+    quarantine: bool = False
+    # share of invalid records above which the combine fails, before anything is uploaded
+    max_invalid_share: float = 1.0
+
+
+def find_json_files(base_path):
+    """
+    Lazily yield all json files below `base_path`.
+    :param base_path: working directory, where all files are resolved, or the S3Source of an s3 prefix
+    :return: generator of file paths, or of S3Objects without content
+    """
+    if isinstance(base_path, S3Source):
+        yield from base_path.list_files()
+        return
+    yield from glob.iglob(base_path + "/**/*.json", recursive=True)
+
+
+def fetch_files(base_path, files):
+    """
+    Download the content of s3 files, local files are read by the parse functions themselves.
+    :param base_path: working directory or S3Source the files were found in
+    :param files: the files of `find_json_files`
+    :return: iterable of the files, ready to be parsed
+    """
+    if isinstance(base_path, S3Source):
+        return base_path.fetch(files)
+    return files
+
+
+def source_name(file):
+    """
+    :param file: a local file path or an S3Object
+    :return: the path or the key of the file
+    """
+    return file.key if isinstance(file, S3Object) else file
+
+
+def source_size(file):
+    """
+    :param file: a local file path or an S3Object
+    :return: the size of the file in bytes
+    """
+    return file.size if isinstance(file, S3Object) else os.path.getsize(file)
+
+
+def open_source(file):
+    """
+    :param file: a local file path or a downloaded S3Object
+    :return: text file object of the file content
+    """
+    if isinstance(file, S3Object):
+        return io.StringIO(file.body.decode("utf-8"))
+    return open(file, 'rt', encoding='utf-8')
+
+
+def event_date(file):
+    """
+    :param file: log file path or S3Object, named like `2018-11-01-events.json`
+    :return: tuple of year, month and day of the file
+    """
+    file_suffix = os.path.basename(source_name(file))
+    file_date = file_suffix.replace("-events.json", "")
+    event_year, event_month, event_day = file_date.split("-")
+    return event_year, event_month, event_day
+
+
+def read_event_file(file, codec="auto"):
+    """
+    Stream the log events of a single file, one record at a time.
+    Every event is extended with the date of the file it was read from.
+    :param file: log file path, named like `2018-11-01-events.json`
+    :param codec: name of the json codec used for parsing, see `json_codec.get_codec`
+    :return: generator of event dicts
+    """
+    loads = get_codec(codec).loads
+    with open_source(file) as log_reader:
+        # extend the payload with the file date for analysis or partition use
+        event_year, event_month, event_day = event_date(file)
+
+        for line in log_reader:
+            json_payload = loads(line)
+            json_payload['event_day'] = event_day
+            json_payload['event_month'] = event_month
+            json_payload['event_year'] = event_year
+            yield json_payload
+
+
+def read_song_file(file, codec="auto"):
+    """
+    Read the single song stored in `file`.
+    :param file: song file path
+    :param codec: name of the json codec used for parsing
+    :return: generator with the song dict
+    """
+    with open_source(file) as song_reader:
+        yield get_codec(codec).loads(song_reader.read())
+
+
+def splice_event_file(file):
+    """
+    Add the file date to the raw event lines of a single file, without parsing them.
+    The udacity log files contain exactly one json object per line.
+    :param file: log file path
+    :return: list of json lines
+    """
+    suffix = event_date_suffix(*event_date(file))
+    with open_source(file) as log_reader:
+        return [splice_fields(line, suffix) for line in log_reader if not line.isspace()]
+
+
+def serialize_event_file(file, codec="auto"):
+    """
+    Parse, enrich and serialize the events of a single file.
+    This is the unit of work that is sent to the worker processes.
+    :param file: log file path
+    :param codec: name of the json codec, `splice` appends the date fields to the raw lines
+    :return: list of json lines
+    """
+    if codec == "splice":
+        return splice_event_file(file)
+    dumps = get_codec(codec).dumps
+    return [dumps(record) for record in read_event_file(file, codec)]
+
+
+def serialize_song_file(file, codec="auto"):
+    """
+    Parse and serialize the song of a single file.
+    This is the unit of work that is sent to the worker processes.
+    The songs are always parsed, to normalize them to a single line.
+    :param file: song file path
+    :param codec: name of the json codec
+    :return: list of json lines
+    """
+    codec = "auto" if codec == "splice" else codec
+    dumps = get_codec(codec).dumps
+    return [dumps(record) for record in read_song_file(file, codec)]
+
+
+def load_event_file(file, codec="auto"):
+    """
+    Parse and enrich the events of a single file, for output formats that need the records.
+    This is the unit of work that is sent to the worker processes.
+    The events are held as compact EventRecords, they are kept in memory until they are written.
+    :param file: log file path
+    :param codec: name of the json codec used for parsing
+    :return: list of EventRecords
+    """
+    return [EventRecord(payload) for payload in read_event_file(file, "auto" if codec == "splice" else codec)]
+
+
+def record_dict(record):
+    """
+    :param record: a song dict or an EventRecord
+    :return: the record as dict, that can be serialized as json
+    """
+    return record.to_dict() if isinstance(record, EventRecord) else record
+
+
+def load_song_file(file, codec="auto"):
+    """
+    Parse the song of a single file, for output formats that need the records.
+    This is the unit of work that is sent to the worker processes.
+    :param file: song file path
+    :param codec: name of the json codec used for parsing
+    :return: list of song dicts
+    """
+    return list(read_song_file(file, "auto" if codec == "splice" else codec))
+
+
+def map_files(files, parse_file, workers=1, ordered=True, chunk_size=PARALLEL_CHUNK_SIZE):
+    """
+    Parse all files with `parse_file` and stream the result of every file.
+    With more than one worker, the files are sharded in chunks across a process pool.
+    :param files: iterable of file paths
+    :param parse_file: function that turns one file into its result
+    :param workers: number of processes, 1 parses in the current process
+    :param ordered: keep the order of `files` in the output, otherwise results are emitted as soon as they are ready
+    :param chunk_size: number of files that are handed to a worker at once
+    :return: generator of the results per file
+    """
+    if workers <= 1:
+        for file in files:
+            yield parse_file(file)
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        pool_map = pool.imap if ordered else pool.imap_unordered
+        yield from pool_map(parse_file, files, chunksize=chunk_size)
+
+
+def parse_files(files, parse_file, workers=1, ordered=True, chunk_size=PARALLEL_CHUNK_SIZE, validator=None):
+    """
+    Parse all files with `parse_file` and stream the results.
+    With more than one worker, the files are sharded in chunks across a process pool.
+    :param files: iterable of file paths
+    :param parse_file: function that turns one file into a list of json lines or records,
+      or into the result of `validate_file` when a `validator` is given
+    :param workers: number of processes, 1 parses in the current process
+    :param ordered: keep the order of `files` in the output, otherwise lines are emitted as soon as they are ready
+    :param chunk_size: number of files that are handed to a worker at once
+    :param validator: the Validator that collects the statistics of the validated files
+    :return: generator of json lines or records
+    """
+    yield from collect_results(map_files(files, parse_file, workers, ordered, chunk_size), validator)
+
+
+def collect_results(results, validator=None):
+    """
+    Stream the json lines or records of the parsed files.
+    :param results: iterable of the results of the parse function per file
+    :param validator: the Validator that collects the statistics of the validated files
+    :return: generator of json lines or records
+    """
+    for lines in results:
+        if validator is not None:
+            lines = validator.collect(lines)
+        yield from lines
+
+
+def write_lines(lines, target, buffer_size=WRITE_BUFFER_SIZE, append=False):
+    """
+    Write the already serialized json lines to `target`.
+    The serialized lines are buffered and written in bulk,
+    so only `buffer_size` records are held in memory at any time.
+    The output is written to a temporary file first and renamed at the end,
+    so an interrupted run never leaves a partial `target` behind.
+    When appending, the lines are added to `target` directly.
+    :param lines: iterable of json strings, without trailing newline
+    :param target: the file to write to
+    :param buffer_size: number of lines per write call
+    :param append: append to an existing `target` instead of replacing it
+    :return: number of lines written
+    """
+    count = 0
+    buffer = []
+    temporary_target = target if append else target + ".tmp"
+    with open(temporary_target, "at" if append else "wt", encoding="utf-8") as json_writer:
+        for line in lines:
+            buffer.append(line)
+            if len(buffer) >= buffer_size:
+                json_writer.write("\n".join(buffer) + "\n")
+                count += len(buffer)
+                buffer.clear()
+        if buffer:
+            json_writer.write("\n".join(buffer) + "\n")
+            count += len(buffer)
+    if not append:
+        os.replace(temporary_target, target)
+    return count
+
+
+def manifest_path(target):
+    """
+    The manifest of `target` lists all source files that are already combined into it.
+    :param target: the combined file, like `events.json`
+    :return: path of the manifest, like `events.sources.json`
+    """
+    return target.replace(".json", "") + ".sources.json"
+
+
+def load_manifest(path):
+    """
+    Load the manifest of already combined source files.
+    :param path: the manifest file
+    :return: the manifest, empty if none was written yet
+    """
+    if not os.path.exists(path):
+        return {"output_size": 0, "files": {}}
+    with open(path, 'rt') as manifest_reader:
+        return json.load(manifest_reader)
+
+
+def save_manifest(manifest, path):
+    """
+    Persist the manifest, replacing the old one in one step.
+    :param manifest: the manifest to write
+    :param path: the manifest file
+    :return: None
+    """
+    with open(path + ".tmp", 'wt') as manifest_writer:
+        json.dump(manifest, manifest_writer, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def file_hash(file):
+    """
+    :param file: the file to hash
+    :return: sha256 hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(file, 'rb') as file_reader:
+        for block in iter(lambda: file_reader.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_fingerprint(file, content_hash=None):
+    """
+    Describe a source file, so a later run can tell if it was changed.
+    :param file: the file to describe
+    :param content_hash: already computed hash of the file, calculated if missing
+    :return: dict with size, mtime and content hash
+    """
+    stat = os.stat(file)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha256": content_hash if content_hash is not None else file_hash(file),
+    }
+
+
+def compare_with_manifest(files, manifest):
+    """
+    Split the source files by comparing them with the manifest.
+    Size and mtime are checked first, the content is only hashed when they differ,
+    so unchanged files from former syncs cost a single stat call.
+    :param files: iterable of source files
+    :param manifest: the manifest of the last combine run
+    :return: tuple of
+      * new files, that are not yet part of the output
+      * changed files, that are part of the output but got new content
+      * fingerprints of all files, that can be written as the new manifest
+    """
+    new_files = []
+    changed_files = []
+    fingerprints = {}
+    for file in files:
+        known = manifest["files"].get(file)
+        if known is not None:
+            stat = os.stat(file)
+            if stat.st_size == known["size"] and stat.st_mtime == known["mtime"]:
+                fingerprints[file] = known
+                continue
+            content_hash = file_hash(file)
+            fingerprints[file] = file_fingerprint(file, content_hash)
+            if content_hash != known["sha256"]:
+                changed_files.append(file)
+        else:
+            fingerprints[file] = file_fingerprint(file)
+            new_files.append(file)
+    return new_files, changed_files, fingerprints
+
+
+def combine_incremental(base_path, target, serialize_file, workers=1, ordered=True, validator=None):
+    """
+    Only append the source files to `target` that were not combined before.
+    A full rebuild is done when no output exists yet or a combined file got changed,
+    as its old records can not be removed from the output.
     :param base_path: working directory, where all files are resolved
+    :param target: the combined file
+    :param serialize_file: function that turns one file into a list of json lines
+    :param workers: number of processes used for parsing
+    :param ordered: keep the file order in the output when running with several workers
+    :param validator: the Validator of the records, optional
+    :return: function that rolls back the output of this run, for a batch that fails the validation
+    """
+    path = manifest_path(target)
+    manifest = load_manifest(path)
+    new_files, changed_files, fingerprints = compare_with_manifest(sorted(find_json_files(base_path)), manifest)
+
+    rebuild = not os.path.exists(target) or len(changed_files) > 0
+    if rebuild:
+        print(f"Combining all {len(fingerprints)} files into {target}, {len(changed_files)} combined files changed")
+        write_lines(parse_files(list(fingerprints), serialize_file, workers, ordered, validator=validator), target)
+        rollback = functools.partial(remove_outputs, [target, path])
+    else:
+        # a former run was interrupted after appending, but before the manifest was saved
+        if os.path.getsize(target) != manifest["output_size"]:
+            os.truncate(target, manifest["output_size"])
+        print(f"Appending {len(new_files)} new files to {target}")
+        write_lines(parse_files(new_files, serialize_file, workers, ordered, validator=validator), target, append=True)
+        rollback = functools.partial(restore_incremental, target, manifest)
+
+    save_manifest({"output_size": os.path.getsize(target), "files": fingerprints}, path)
+    return rollback
+
+
+def restore_incremental(target, manifest):
+    """
+    Remove the lines appended by a run of `combine_incremental`, the batches combined before stay.
+    :param target: the combined file
+    :param manifest: the manifest before the run
+    :return: None
+    """
+    os.truncate(target, manifest["output_size"])
+    save_manifest(manifest, manifest_path(target))
+
+
+def shard_count(estimated_size, settings):
+    """
+    :param estimated_size: expected uncompressed size of the combined output in bytes
+    :param settings: the ShardSettings
+    :return: the number of shards, rounded up to a multiple of the slice count
+    """
+    count = max(1, math.ceil(estimated_size / settings.target_size))
+    return math.ceil(count / settings.slices) * settings.slices
+
+
+def open_shard(path, compression):
+    """
+    Open a shard for writing text, compressed as configured.
+    :param path: the shard file
+    :param compression: one of SHARD_EXTENSIONS
+    :return: writable text file object
+    """
+    if compression == "gzip":
+        # level 6 is the usual trade off, the default of 9 is several times slower for little gain
+        return gzip.open(path, "wt", compresslevel=6, encoding="utf-8")
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstd compression requires the 'zstandard' package: pip3 install zstandard")
+        return zstandard.open(path, "wt", encoding="utf-8")
+    return open(path, "wt", encoding="utf-8")
+
+
+def write_shards(lines, target_dir, name, count, compression="gzip", buffer_size=WRITE_BUFFER_SIZE):
+    """
+    Distribute the json lines round-robin over `count` shards,
+    so all shards end up with about the same size and the slices finish the COPY at the same time.
+    Every shard gets its own write buffer, together they hold at most `buffer_size` lines.
+    :param lines: iterable of json strings, without trailing newline
+    :param target_dir: the directory the shards are written to
+    :param name: the prefix of the shard file names, like `events`
+    :param count: the number of shards
+    :param compression: one of SHARD_EXTENSIONS
+    :param buffer_size: number of lines buffered over all shards
+    :return: list of the written shard paths
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    for old_shard in glob.glob(os.path.join(target_dir, f"{name}-*.json*")):
+        os.remove(old_shard)
+
+    paths = [os.path.join(target_dir, f"{name}-{index:04d}.json{SHARD_EXTENSIONS[compression]}") for index in range(count)]
+    writers = [open_shard(path, compression) for path in paths]
+    buffers = [[] for _ in range(count)]
+    shard_buffer_size = max(1, buffer_size // count)
+    try:
+        for index, line in enumerate(lines):
+            buffer = buffers[index % count]
+            buffer.append(line)
+            if len(buffer) >= shard_buffer_size:
+                writers[index % count].write("\n".join(buffer) + "\n")
+                buffer.clear()
+        for writer, buffer in zip(writers, buffers):
+            if buffer:
+                writer.write("\n".join(buffer) + "\n")
+    finally:
+        for writer in writers:
+            writer.close()
+    return paths
+
+
+def write_copy_manifest(shard_paths, target, s3_prefix):
+    """
+    Write the manifest that lets one redshift COPY load all shards in parallel.
+    See https://docs.aws.amazon.com/redshift/latest/dg/loading-data-files-using-manifest.html
+    :param shard_paths: the local shard files, relative to the upload directory
+    :param target: the manifest file, like `events.manifest`
+    :param s3_prefix: the s3 location the shards are uploaded to, like `s3://my-bucket/sparkify`
+    :return: None
+    """
+    entries = []
+    for shard_path in shard_paths:
+        entries.append({
+            "url": s3_prefix.rstrip("/") + "/" + shard_path.replace(os.sep, "/"),
+            "mandatory": True,
+            "meta": {"content_length": os.path.getsize(shard_path)},
+        })
+    with open(target, "wt") as manifest_writer:
+        json.dump({"entries": entries}, manifest_writer, indent=1)
+
+
+def combine_sharded(base_path, name, serialize_file, settings, workers=1, ordered=True, validator=None):
+    """
+    Combine all source files into compressed shards plus a COPY manifest.
+    The shards are written to the directory `name`, the manifest to `name.manifest`.
+    The number of shards is estimated from the size of the source files.
+    :param base_path: working directory, where all files are resolved, or the S3Source of an s3 prefix
+    :param name: name of the output, like `events`
+    :param serialize_file: function that turns one file into a list of json lines
+    :param settings: the ShardSettings
+    :param workers: number of processes used for parsing
+    :param ordered: keep the file order in the output when running with several workers
+    :param validator: the Validator of the records, optional
+    :return: the written shard directory and manifest
+    """
+    files = list(find_json_files(base_path))
+    count = shard_count(sum(source_size(file) for file in files), settings)
+    print(f"Combining {len(files)} files into {count} shards of {name}")
+    lines = parse_files(fetch_files(base_path, files), serialize_file, workers, ordered, validator=validator)
+    shard_paths = write_shards(lines, name, name, count, settings.compression)
+    write_copy_manifest(shard_paths, name + ".manifest", settings.s3_prefix)
+    return [name, name + ".manifest"]
+
+
+def partition_path(target_dir, event_year, event_month, event_day):
+    """
+    :param target_dir: the directory of the partitioned output, like `events_partitioned`
+    :return: the Hive style directory of the day, like `events_partitioned/year=2018/month=11/day=01`
+    """
+    return os.path.join(target_dir, f"year={event_year}", f"month={event_month}", f"day={event_day}")
+
+
+def find_partitions(target_dir):
+    """
+    :param target_dir: the directory of the partitioned output
+    :return: sorted list of (year, month, day) of the written partitions
+    """
+    partitions = []
+    for path in glob.glob(partition_path(target_dir, "*", "*", "*")):
+        if path.endswith(".tmp"):
+            continue
+        parts = path.split(os.sep)[-3:]
+        partitions.append(tuple(part.split("=", 1)[1] for part in parts))
+    return sorted(partitions)
+
+
+def combine_partitioned(base_path, name, serialize_file, settings, workers=1, validator=None):
+    """
+    Combine the log events into one directory per day of the log files,
+    Hive style partitioned as `name`_partitioned/year=YYYY/month=MM/day=DD, with compressed shards in each.
+    A query of the external table in `sql_queries.py` on some days only reads the files of these days.
+    Days that are already written are kept, so after a daily sync only the new days are combined.
+    Every day is written to a temporary directory first, so an interrupted run never leaves a partial day behind.
+    :param base_path: working directory, where all files are resolved, or the S3Source of an s3 prefix
+    :param name: name of the output, like `events`
+    :param serialize_file: function that turns one file into a list of json lines
+    :param settings: the ShardSettings, the shard count is estimated per day
+    :param workers: number of processes used for parsing, the files are always combined in order of their day
+    :param validator: the Validator of the records, optional
+    :return: the directories of the written days
+    """
+    target_dir = name + "_partitioned"
+    files = sorted(find_json_files(base_path), key=event_date)
+    new_files = [file for file in files if not os.path.exists(partition_path(target_dir, *event_date(file)))]
+    day_sizes = {}
+    for file in new_files:
+        day_sizes[event_date(file)] = day_sizes.get(event_date(file), 0) + source_size(file)
+    print(f"Combining {len(new_files)} files into {len(day_sizes)} new partitions of {name}, "
+          f"{len(find_partitions(target_dir))} partitions are kept")
+
+    results = zip(new_files, map_files(fetch_files(base_path, new_files), serialize_file, workers))
+    written = []
+    for day, day_results in itertools.groupby(results, key=lambda file_result: event_date(file_result[0])):
+        path = partition_path(target_dir, *day)
+        count = shard_count(day_sizes[day], settings)
+        lines = collect_results((result for _, result in day_results), validator)
+        write_shards(lines, path + ".tmp", name, count, settings.compression)
+        os.replace(path + ".tmp", path)
+        written.append(path)
+    return written
+
+
+def import_pyarrow():
+    """
+    pyarrow is only needed for the parquet output, so it is imported on demand.
+    :return: the modules pyarrow and pyarrow.parquet
+    """
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("parquet output requires the 'pyarrow' package: pip3 install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+
+def arrow_type(pyarrow, column_type):
+    """
+    :param pyarrow: the pyarrow module
+    :param column_type: type of a column in EVENT_COLUMNS or SONG_COLUMNS
+    :return: the matching arrow type
+    """
+    if column_type.startswith("decimal"):
+        precision, scale = column_type[len("decimal("):-1].split(",")
+        return pyarrow.decimal128(int(precision), int(scale))
+    return {"string": pyarrow.string(), "int32": pyarrow.int32(), "int64": pyarrow.int64()}[column_type]
+
+
+def convert_value(value, column_type):
+    """
+    Convert a json value to the python value of the parquet column.
+    Empty strings in numeric columns, like the `userId` of logged out users, become null.
+    :param value: the json value
+    :param column_type: type of a column in EVENT_COLUMNS or SONG_COLUMNS
+    :return: the converted value
+    """
+    if value is None or (value == "" and column_type != "string"):
+        return None
+    if column_type == "string":
+        return str(value)
+    if column_type.startswith("decimal"):
+        scale = int(column_type[:-1].split(",")[1])
+        return Decimal(str(value)).quantize(Decimal(1).scaleb(-scale))
+    return int(value)
+
+
+def records_to_table(pyarrow, records, columns, schema):
+    """
+    Turn a batch of records into a typed, columnar arrow table.
+    :param pyarrow: the pyarrow module
+    :param records: list of song dicts or EventRecords
+    :param columns: EVENT_COLUMNS or SONG_COLUMNS
+    :param schema: the arrow schema of `columns`
+    :return: the arrow table
+    """
+    data = {}
+    event_records = bool(records) and isinstance(records[0], EventRecord)
+    for column_name, json_key, column_type in columns:
+        if event_records:
+            # the column is read from the slots directly, without a method call per value
+            values = [getattr(record, json_key, None) for record in records]
+            if json_key in TYPED_KEYS:
+                data[column_name] = typed_column(pyarrow, values, column_type)
+                continue
+        else:
+            values = [record.get(json_key) for record in records]
+        data[column_name] = [convert_value(value, column_type) for value in values]
+    return pyarrow.Table.from_pydict(data, schema=schema)
+
+
+def typed_column(pyarrow, values, column_type):
+    """
+    Build the arrow column of values that were already converted by the EventRecord, in a single call.
+    Decimals are rounded half to even to their scale, like `Decimal.quantize` in `convert_value`.
+    :param pyarrow: the pyarrow module
+    :param values: the ints or floats of the column, None for null
+    :param column_type: type of a column in EVENT_COLUMNS
+    :return: the arrow array
+    """
+    target_type = arrow_type(pyarrow, column_type)
+    if column_type.startswith("decimal"):
+        floats = pyarrow.array(values, pyarrow.float64())
+        return pyarrow.compute.round(floats, target_type.scale).cast(target_type)
+    return pyarrow.array(values, target_type)
+
+
+def write_parquet(records, target_dir, name, columns, count, compression="gzip", batch_size=WRITE_BUFFER_SIZE):
+    """
+    Write the records as typed parquet files, matching the staging table DDL.
+    Batches of `batch_size` records are converted to a row group and distributed round-robin over `count` files,
+    so a COPY of the directory loads the files in parallel.
+    :param records: iterable of song dicts or EventRecords
+    :param target_dir: the directory the files are written to
+    :param name: the prefix of the file names, like `events`
+    :param columns: EVENT_COLUMNS or SONG_COLUMNS
+    :param count: the number of files
+    :param compression: one of PARQUET_COMPRESSION
+    :param batch_size: number of records per row group
+    :return: list of the written file paths
+    """
+    pyarrow, parquet = import_pyarrow()
+    schema = pyarrow.schema([(column_name, arrow_type(pyarrow, column_type)) for column_name, _, column_type in columns])
+
+    os.makedirs(target_dir, exist_ok=True)
+    for old_file in glob.glob(os.path.join(target_dir, f"{name}-*.parquet")):
+        os.remove(old_file)
+
+    paths = [os.path.join(target_dir, f"{name}-{index:04d}.parquet") for index in range(count)]
+    writers = [parquet.ParquetWriter(path, schema, compression=PARQUET_COMPRESSION[compression]) for path in paths]
+    batch = []
+    batch_index = 0
+    try:
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                writers[batch_index % count].write_table(records_to_table(pyarrow, batch, columns, schema))
+                batch_index += 1
+                batch.clear()
+        if batch:
+            writers[batch_index % count].write_table(records_to_table(pyarrow, batch, columns, schema))
+    finally:
+        for writer in writers:
+            writer.close()
+    return paths
+
+
+def combine_parquet(base_path, name, load_file, columns, settings, workers=1, ordered=True, validator=None):
+    """
+    Combine all source files into parquet files in the directory `name`_parquet.
+    The number of files is estimated from the size of the source files, like for the json shards.
+    :param base_path: working directory, where all files are resolved, or the S3Source of an s3 prefix
+    :param name: name of the output, like `events`
+    :param load_file: function that turns one file into a list of records
+    :param columns: EVENT_COLUMNS or SONG_COLUMNS
+    :param settings: the ShardSettings
+    :param workers: number of processes used for parsing
+    :param ordered: keep the file order in the output when running with several workers
+    :param validator: the Validator of the records, optional
+    :return: the written directory
+    """
+    files = list(find_json_files(base_path))
+    count = shard_count(sum(source_size(file) for file in files), settings)
+    print(f"Combining {len(files)} files into {count} parquet files of {name}")
+    records = parse_files(fetch_files(base_path, files), load_file, workers, ordered, validator=validator)
+    write_parquet(records, name + "_parquet", name, columns, count, settings.compression)
+    return [name + "_parquet"]
+
+
+def new_stats(columns):
+    """
+    :param columns: EVENT_COLUMNS or SONG_COLUMNS
+    :return: empty statistics of the columns that are read from json
+    """
+    return {
+        "records": 0,
+        "invalid": 0,
+        "fields": {column_name: {"null": 0, "invalid": 0, "min": None, "max": None}
+                   for column_name, _, _ in columns},
+    }
+
+
+def validate_value(value, column_type):
+    """
+    Convert a json value like `convert_value` and check that it fits into the staging table.
+    :param value: the json value
+    :param column_type: type of a column in EVENT_COLUMNS or SONG_COLUMNS
+    :return: tuple of the converted value, or None if it is null, and the comparable size of the value,
+      the length in bytes for strings, raises ValueError if the value does not fit the column
+    """
+    try:
+        value = convert_value(value, column_type)
+    except (ValueError, TypeError, ArithmeticError):
+        raise ValueError(f"not {column_type}")
+    if value is None or value == "":
+        return None, None
+    if column_type == "string":
+        size = len(value.encode("utf-8"))
+        if size > MAX_STRING_BYTES:
+            raise ValueError(f"longer than {MAX_STRING_BYTES} bytes")
+        return value, size
+    if column_type.startswith("decimal"):
+        precision, scale = column_type[len("decimal("):-1].split(",")
+        if abs(value) >= 10 ** (int(precision) - int(scale)):
+            raise ValueError(f"out of range of {column_type}")
+        return value, float(value)
+    low, high = INTEGER_RANGES[column_type]
+    if not low <= value <= high:
+        raise ValueError(f"out of range of {column_type}")
+    return value, value
+
+
+def validate_record(record, columns, required_columns, stats):
+    """
+    Count the nulls, type violations and value ranges of one record into `stats`.
+    The range of a string column is the range of its length in bytes.
+    :param record: the json record, a song dict or an EventRecord
+    :param columns: EVENT_COLUMNS or SONG_COLUMNS
+    :param required_columns: the columns that must not be null
+    :param stats: the statistics of `new_stats`, updated in place
+    :return: list of the problems of the record, empty if it is valid
+    """
+    problems = []
+    stats["records"] += 1
+    for column_name, json_key, column_type in columns:
+        field = stats["fields"].get(column_name)
+        if field is None:
+            continue
+        try:
+            value, size = validate_value(record.get(json_key), column_type)
+        except ValueError as error:
+            field["invalid"] += 1
+            problems.append(f"{column_name}: {error}")
+            continue
+        if value is None:
+            field["null"] += 1
+            if column_name in required_columns:
+                problems.append(f"{column_name}: missing")
+            continue
+        if field["min"] is None or size < field["min"]:
+            field["min"] = size
+        if field["max"] is None or size > field["max"]:
+            field["max"] = size
+    if problems:
+        stats["invalid"] += 1
+    return problems
+
+
+def merge_stats(stats, other):
+    """
+    Add the statistics of another file to `stats`.
+    :param stats: the statistics of `new_stats`, updated in place
+    :param other: the statistics to add
     :return: None
     """
-    if not os.path.exists("events.json"):
-        result = []
-        for file in glob.glob(base_path + "/**/*.json", recursive=True):
-            with open(file, 'rt') as log_reader:
-                # extend the payload with the file date for analysis or partition use
-                file_suffix = file.split(os.sep)[-1]
-                file_date = file_suffix.replace("-events.json", "")
-                event_year, event_month, event_day = file_date.split("-")
+    stats["records"] += other["records"]
+    stats["invalid"] += other["invalid"]
+    for column_name, other_field in other["fields"].items():
+        field = stats["fields"][column_name]
+        field["null"] += other_field["null"]
+        field["invalid"] += other_field["invalid"]
+        for key, pick in (("min", min), ("max", max)):
+            if other_field[key] is not None:
+                field[key] = other_field[key] if field[key] is None else pick(field[key], other_field[key])
 
-                for line in log_reader:
-                    json_payload = json.loads(line)
-                    json_payload['event_day'] = event_day
-                    json_payload['event_month'] = event_month
-                    json_payload['event_year'] = event_year
-                    result.append(json_payload)
 
-        with open("events.json", "wt") as json_writer:
-            for line in result:
-                json_writer.write(json.dumps(line) + "\n")
+def validate_file(file, load_file, columns, required_columns, serialize=True, codec="auto", quarantine=False):
+    """
+    Parse and validate the records of a single file.
+    This is the unit of work that is sent to the worker processes, in place of the serialize or load function.
+    :param file: the source file
+    :param load_file: `load_event_file` or `load_song_file`
+    :param columns: EVENT_COLUMNS or SONG_COLUMNS
+    :param required_columns: the columns that must not be null
+    :param serialize: return json lines, otherwise records
+    :param codec: name of the json codec used for serializing
+    :param quarantine: leave the invalid records out of the output
+    :return: tuple of the json lines or records, the rejected json lines and the statistics of the file
+    """
+    dumps = get_codec("auto" if codec == "splice" else codec).dumps
+    stats = new_stats(columns)
+    output = []
+    rejected = []
+    for record in load_file(file):
+        problems = validate_record(record, columns, required_columns, stats)
+        if problems and quarantine:
+            rejected.append(json.dumps(dict(record_dict(record), _source=source_name(file), _problems=problems)))
+        else:
+            output.append(dumps(record_dict(record)) if serialize else record)
+    return output, rejected, stats
+
+
+class Validator:
+    """
+    Collects the results of `validate_file` in the main process:
+    sums up the statistics and writes the rejected records to the quarantine file.
+    """
+
+    def __init__(self, name, columns, settings):
+        """
+        :param name: name of the output, like `events`
+        :param columns: EVENT_COLUMNS or SONG_COLUMNS
+        :param settings: the ValidationSettings
+        """
+        self.name = name
+        self.settings = settings
+        self.stats = new_stats(columns)
+        self.files = 0
+        self.quarantine_writer = None
+
+    def collect(self, result):
+        """
+        :param result: the result of `validate_file` for one file
+        :return: the json lines or records of the file, that go into the output
+        """
+        output, rejected, stats = result
+        if self.files == 0 and self.settings.quarantine:
+            self.quarantine_writer = open(f"{self.name}.quarantine.json", "wt", encoding="utf-8")
+        self.files += 1
+        merge_stats(self.stats, stats)
+        if rejected:
+            self.quarantine_writer.write("\n".join(rejected) + "\n")
+        return output
+
+    def finish(self, rollback=None):
+        """
+        Write the statistics to the sidecar `<name>.stats.json`
+        and fail if the share of invalid records is above the limit of the settings.
+        A failed batch is rolled back, otherwise the next run would find the output, skip it and upload it.
+        Nothing is written when no file was combined.
+        :param rollback: function that removes the output of this run, optional
+        :return: None
+        """
+        if self.files == 0:
+            return
+        if self.quarantine_writer is not None:
+            self.quarantine_writer.close()
+        records = self.stats["records"]
+        invalid_share = self.stats["invalid"] / records if records else 0
+        passed = invalid_share <= self.settings.max_invalid_share
+        with open(f"{self.name}.stats.json", "wt") as stats_writer:
+            json.dump(dict(self.stats, files=self.files, quarantined=self.settings.quarantine, passed=passed),
+                      stats_writer, indent=1, default=float)
+        print(f"Validated {records} records of {self.name}, {self.stats['invalid']} invalid")
+        if not passed:
+            if rollback is not None:
+                rollback()
+            raise RuntimeError(f"{invalid_share:.1%} of the {self.name} records are invalid, "
+                               f"more than {self.settings.max_invalid_share:.1%}, see {self.name}.stats.json, "
+                               f"the output of this run was rolled back")
+
+
+def remove_outputs(paths):
+    """
+    :param paths: the files and directories to delete, missing ones are skipped
+    :return: None
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
 
 
-def combine_songs(base_path):
+def combine_events(base_path, workers=1, ordered=True, incremental=False, sharding=None, output_format="json",
+                   codec="auto", validation=None):
+    """
+    This combines all log events from the local copy of the udacity s3 bucket
+    and writes it out as one single file.
+
+    This improves the COPY execution on redshift a lot.
+    :param base_path: working directory, where all files are resolved, or the S3Source of an s3 prefix
+    :param workers: number of processes used for parsing
+    :param ordered: keep the file order in the output when running with several workers
+    :param incremental: only append newly synced files, tracked in `events.sources.json`
+    :param sharding: ShardSettings to write compressed shards and `events.manifest` instead of one file
+    :param output_format: `json`, `parquet` to write typed files to `events_parquet`
+      or `partitioned` to write compressed shards per day to `events_partitioned`
+    :param codec: name of the json codec, `splice` adds the date fields without parsing the events
+    :param validation: ValidationSettings to validate the records, written to `events.stats.json`
+    :return: None
+    """
+    serialize_file = functools.partial(serialize_event_file, codec=codec)
+    load_file = functools.partial(load_event_file, codec=codec)
+    validator = None
+    if validation is not None:
+        validator = Validator("events", EVENT_COLUMNS, validation)
+        validate = functools.partial(validate_file, load_file=load_file, columns=EVENT_COLUMNS,
+                                     required_columns=EVENT_REQUIRED_COLUMNS, codec=codec,
+                                     quarantine=validation.quarantine)
+        serialize_file = functools.partial(validate, serialize=True)
+        load_file = functools.partial(validate, serialize=False)
+    outputs = []
+    rollback = None
+    if output_format == "partitioned":
+        outputs = combine_partitioned(base_path, "events", serialize_file, sharding or ShardSettings(), workers,
+                                      validator)
+    elif output_format == "parquet":
+        if not os.path.exists("events_parquet"):
+            outputs = combine_parquet(base_path, "events", load_file, EVENT_COLUMNS, sharding or ShardSettings(), workers,
+                                      ordered, validator)
+    elif sharding is not None:
+        if not os.path.exists("events.manifest"):
+            outputs = combine_sharded(base_path, "events", serialize_file, sharding, workers, ordered, validator)
+    elif incremental:
+        rollback = combine_incremental(base_path, "events.json", serialize_file, workers, ordered, validator)
+    elif not os.path.exists("events.json"):
+        files = find_json_files(base_path)
+        lines = parse_files(fetch_files(base_path, files), serialize_file, workers, ordered, validator=validator)
+        write_lines(lines, "events.json")
+        outputs = ["events.json"]
+    if validator is not None:
+        # the other outputs are written completely by every run, a failed one is removed
+        validator.finish(rollback or functools.partial(remove_outputs, outputs))
+
+
+def combine_songs(base_path, workers=1, ordered=True, incremental=False, sharding=None, output_format="json",
+                   codec="auto", validation=None):
     """
     This combines all song data from the local copy of the udacity s3 bucket
     and writes it out as one single file.
 
     This improves the COPY execution on redshift a lot.
-    :param base_path: working directory, where all files are resolved
+    :param base_path: working directory, where all files are resolved, or the S3Source of an s3 prefix
+    :param workers: number of processes used for parsing
+    :param ordered: keep the file order in the output when running with several workers
+    :param incremental: only append newly synced files, tracked in `songs.sources.json`
+    :param sharding: ShardSettings to write compressed shards and `songs.manifest` instead of one file
+    :param output_format: `json`, or `parquet` to write typed files to `songs_parquet`,
+      songs have no day, with `partitioned` they are written like the sharded output
+    :param codec: name of the json codec
+    :param validation: ValidationSettings to validate the records, written to `songs.stats.json`
     :return: None
     """
-    if not os.path.exists("songs.json"):
-        result = []
-        for file in glob.glob(base_path + "/**/*.json", recursive=True):
-            with open(file, 'rt') as log_reader:
-                line = log_reader.read()
-                json_payload = json.loads(line)
-                result.append(json_payload)
+    serialize_file = functools.partial(serialize_song_file, codec=codec)
+    load_file = functools.partial(load_song_file, codec=codec)
+    validator = None
+    if validation is not None:
+        validator = Validator("songs", SONG_COLUMNS, validation)
+        validate = functools.partial(validate_file, load_file=load_file, columns=SONG_COLUMNS,
+                                     required_columns=SONG_REQUIRED_COLUMNS, codec=codec,
+                                     quarantine=validation.quarantine)
+        serialize_file = functools.partial(validate, serialize=True)
+        load_file = functools.partial(validate, serialize=False)
+    outputs = []
+    rollback = None
+    if output_format == "parquet":
+        if not os.path.exists("songs_parquet"):
+            outputs = combine_parquet(base_path, "songs", load_file, SONG_COLUMNS, sharding or ShardSettings(), workers,
+                                      ordered, validator)
+    elif sharding is not None:
+        if not os.path.exists("songs.manifest"):
+            outputs = combine_sharded(base_path, "songs", serialize_file, sharding, workers, ordered, validator)
+    elif incremental:
+        rollback = combine_incremental(base_path, "songs.json", serialize_file, workers, ordered, validator)
+    elif not os.path.exists("songs.json"):
+        files = find_json_files(base_path)
+        lines = parse_files(fetch_files(base_path, files), serialize_file, workers, ordered, validator=validator)
+        write_lines(lines, "songs.json")
+        outputs = ["songs.json"]
+    if validator is not None:
+        # the other outputs are written completely by every run, a failed one is removed
+        validator.finish(rollback or functools.partial(remove_outputs, outputs))
 
-        with open("songs.json", "wt") as json_writer:
-            for line in result:
-                json_writer.write(json.dumps(line) + "\n")
+
+def parse_arguments():
+    """
+    Parse the command line options of the combine step.
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Combine the local copy of the udacity s3 bucket into single files.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of parsing processes, 0 uses all available cores (default: 1)")
+    parser.add_argument("--unordered", action="store_true",
+                        help="write records as soon as a worker is done instead of keeping the file order")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only append files that are not yet listed in the manifest of the combined file")
+    parser.add_argument("--output", choices=["single", "sharded", "parquet", "partitioned"], default="single",
+                        help="one json file per dataset, compressed shards with a COPY manifest, "
+                             "typed parquet files or compressed shards in one directory per day of the events, "
+                             "for an external table of redshift spectrum (default: single)")
+    parser.add_argument("--shard-size-mb", type=int, default=128,
+                        help="uncompressed size of one shard in MB (default: 128)")
+    parser.add_argument("--slices", type=int, default=2,
+                        help="number of slices of the redshift cluster, the shard count is a multiple of it (default: 2)")
+    parser.add_argument("--compression", choices=list(SHARD_EXTENSIONS), default="gzip",
+                        help="compression of the shards or inside the parquet files (default: gzip)")
+    parser.add_argument("--s3-prefix", default="s3://<BUCKET>/<PATH>",
+                        help="s3 location the shard directories are uploaded to, used in the COPY manifest")
+    parser.add_argument("--source", default=".",
+                        help="where log_data and song_data are read from, a local copy or an s3 location "
+                             "like s3://udacity-dend, whose objects are downloaded into memory (default: .)")
+    parser.add_argument("--upload", action="store_true",
+                        help="upload the combined output below --s3-prefix, unchanged files are skipped")
+    parser.add_argument("--transfer-concurrency", type=int, default=32,
+                        help="objects downloaded or parts uploaded at the same time (default: 32)")
+    parser.add_argument("--endpoint-url",
+                        help="s3 endpoint for --source and --upload, like a local moto server (default: aws)")
+    parser.add_argument("--codec", choices=["auto", "splice"] + list(CODEC_FACTORIES), default="auto",
+                        help="json implementation, auto uses the fastest installed one. "
+                             "splice appends the date fields to the raw event lines without parsing them (default: auto)")
+    parser.add_argument("--validate", action="store_true",
+                        help="count nulls, type violations and value ranges per field into events.stats.json and "
+                             "songs.stats.json, the records are parsed even with --codec splice")
+    parser.add_argument("--quarantine", action="store_true",
+                        help="with --validate, write invalid records to events.quarantine.json and "
+                             "songs.quarantine.json instead of the output")
+    parser.add_argument("--max-invalid-share", type=float, default=1.0,
+                        help="with --validate, fail if a larger share of the records is invalid (default: 1, never fail)")
+    args = parser.parse_args()
+    if args.output != "single" and args.incremental:
+        parser.error("--incremental only works with --output single")
+    if args.source.startswith("s3://") and args.incremental:
+        parser.error("--incremental only works with a local copy of the bucket")
+    if args.upload and (not args.s3_prefix.startswith("s3://") or "<" in args.s3_prefix):
+        parser.error("--upload requires the --s3-prefix to upload to")
+    return args
 
 
 def main():
+    args = parse_arguments()
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+    ordered = not args.unordered
+    sharding = None
+    if args.output in ("sharded", "parquet", "partitioned"):
+        sharding = ShardSettings(args.shard_size_mb * 1024 * 1024, args.slices, args.compression, args.s3_prefix)
+
     log_path = "log_data"
     song_path = "song_data"
-    combine_events(os.path.join(".", log_path))
-    combine_songs(os.path.join(".", song_path))
+    output_format = args.output if args.output in ("parquet", "partitioned") else "json"
+    validation = ValidationSettings(args.quarantine, args.max_invalid_share) if args.validate else None
+    transfer = TransferSettings(args.transfer_concurrency, endpoint_url=args.endpoint_url)
+    client = create_client(transfer) if args.source.startswith("s3://") or args.upload else None
+    if args.source.startswith("s3://"):
+        log_base_path = S3Source(args.source.rstrip("/") + "/" + log_path, client, transfer)
+        song_base_path = S3Source(args.source.rstrip("/") + "/" + song_path, client, transfer)
+    else:
+        log_base_path = os.path.join(args.source, log_path)
+        song_base_path = os.path.join(args.source, song_path)
+    combine_events(log_base_path, workers, ordered, args.incremental, sharding, output_format, args.codec, validation)
+    combine_songs(song_base_path, workers, ordered, args.incremental, sharding, output_format, args.codec, validation)
+    if args.upload:
+        upload(OUTPUT_PATHS[args.output], args.s3_prefix, client, transfer)
 
 
 if __name__ == '__main__':
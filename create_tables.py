@@ -1,5 +1,5 @@
-import configparser
-import psycopg2
+import database
+from instrumentation import query_log
 from sql_queries import create_table_queries, drop_table_queries
 
 
@@ -12,8 +12,7 @@ def drop_tables(cur, conn):
     """
     for query in drop_table_queries:
         print(query)
-        cur.execute(query)
-        conn.commit()
+        database.execute(cur, conn, query)
 
 
 def create_tables(cur, conn):
@@ -25,25 +24,17 @@ def create_tables(cur, conn):
     """
     for query in create_table_queries:
         print(query)
-        cur.execute(query)
-        conn.commit()
+        database.execute(cur, conn, query)
 
 
 def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
-
-    host = config.get("CLUSTER", "host")
-    db_name = config.get("CLUSTER", "db_name")
-    db_user = config.get("CLUSTER", "db_user")
-    db_password = config.get("CLUSTER", "db_password")
-    db_port = config.get("CLUSTER", "db_port")
-
-    conn = psycopg2.connect(f"host={host} dbname={db_name} user={db_user} password={db_password} port={db_port}")
+    conn = database.connect(database.load_settings())
     cur = conn.cursor()
 
+    query_log.start("create_tables")
     drop_tables(cur, conn)
     create_tables(cur, conn)
+    query_log.print_summary()
 
     conn.close()
 
@@ -1,6 +1,22 @@
-import configparser
+import argparse
+import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-import psycopg2
+import psycopg2.extras
+
+import database
+from instrumentation import query_log
+from sql_queries import dq_history_table_create, table_keys
+
+# bookkeeping of the ELT and of the profiles, not data, so they are neither checked nor profiled
+bookkeeping_tables = {"etl_high_water_mark", "dq_history"}
+
+# columns that grow with every load, an incremental profile only reads the rows above the last profiled value
+increment_columns = {"log_data": "ts", "fact_songplays": "start_time", "dim_time": "start_time"}
+
+# the columns of dq_history, in the order `save_profile` inserts them
+profile_columns = ["profiled_at", "table_name", "column_name", "sample_fraction", "row_count", "null_count",
+                   "distinct_count", "min_value", "max_value", "p50", "p95", "increment_from", "increment_to"]
 
 
 def fetch_meta_data() -> str:
@@ -14,29 +30,77 @@ def fetch_meta_data() -> str:
     """
 
 
-def count_check(table: str) -> str:
+def table_check(table: str, columns: list[str], key=None) -> str:
     """
-    :argument table: The table to check
+    All checks of a table in a single scan:
+    the row count, the non null count of every column
+    and, if the table has a key, the number of rows that share their key with another row.
+    :param table: The table to check
+    :param columns: The columns to check
+    :param key: The column that has to be unique, or a list of columns that are unique together, optional
     :return: Ready to use query
     """
-    return f"SELECT COUNT(*) FROM {table};"
+    aggregates = ["COUNT(*)"] + [f'COUNT("{column}")' for column in columns]
+    if isinstance(key, str):
+        aggregates.append(f'COUNT("{key}") - COUNT(DISTINCT "{key}")')
+    elif key is not None:
+        # there is no COUNT(DISTINCT) over several columns in redshift, so they are counted as one text
+        combined = " || '|' || ".join(f"""COALESCE(CAST("{column}" AS VARCHAR), '')""" for column in key)
+        aggregates.append(f"COUNT(*) - COUNT(DISTINCT {combined})")
+    return f"SELECT {', '.join(aggregates)} FROM {table};"
 
 
-def null_check(table: str, column: str):
+def fetch_numeric_columns() -> str:
     """
-    Stack overflow helped here: https://stackoverflow.com/questions/239545/how-do-i-return-my-records-grouped-by-null-and-not-null
-    :param table: The table to check
-    :param column: The column to check
-    :return: Ready to use query
+    :return: query for the table, column pairs that have percentiles
     """
-    return f"""
-    SELECT
-    COUNT(CASE WHEN {column} IS NULL THEN 1 ELSE NULL END) AS null_count,
-    COUNT(CASE WHEN {column} IS NOT NULL THEN 1 ELSE NULL END) AS non_null_count
-    FROM {table}
+    return """
+    SELECT table_name, column_name FROM information_schema.columns where table_catalog = 'dwh' and table_schema = 'public' 
+    and data_type in ('smallint', 'integer', 'bigint', 'numeric', 'real', 'double precision')
     """
 
 
+def profile_filter(table: str, sample_fraction: float, increment_from: str = None) -> tuple[str, list]:
+    """
+    The rows of a table that are profiled.
+    :param table: The table to profile
+    :param sample_fraction: share of the rows that is sampled, 1 reads all rows. The sample saves the aggregation,
+      not the scan, redshift has no TABLESAMPLE
+    :param increment_from: only rows above this value of the increment column are read, optional
+    :return: the WHERE clause, empty for all rows, and its query parameters
+    """
+    conditions = []
+    parameters = []
+    if increment_from is not None:
+        conditions.append(f'"{increment_columns[table]}" > %s')
+        parameters.append(increment_from)
+    if sample_fraction < 1:
+        conditions.append(f"RANDOM() < {sample_fraction}")
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), parameters
+
+
+def profile_query(table: str, columns: list[str], numeric_columns: set[str], where: str) -> str:
+    """
+    The approximate statistics of all columns of a table in a single scan:
+    the row count, then the non null count, the approximate distinct count, the minimum and the maximum per column,
+    followed by the approximate median and 95th percentile for the numeric columns.
+    Unlike PERCENTILE_CONT, the approximate percentiles of a query may order by different columns.
+    :param table: The table to profile
+    :param columns: The columns to profile
+    :param numeric_columns: The columns that get percentiles
+    :param where: The WHERE clause of `profile_filter`
+    :return: Ready to use query
+    """
+    aggregates = ["COUNT(*)"]
+    for column in columns:
+        aggregates += [f'COUNT("{column}")', f'APPROXIMATE COUNT(DISTINCT "{column}")', f'MIN("{column}")',
+                       f'MAX("{column}")']
+        if column in numeric_columns:
+            aggregates += [f'APPROXIMATE PERCENTILE_DISC(0.5) WITHIN GROUP (ORDER BY "{column}")',
+                           f'APPROXIMATE PERCENTILE_DISC(0.95) WITHIN GROUP (ORDER BY "{column}")']
+    return f"SELECT {', '.join(aggregates)} FROM {table}{where};"
+
+
 def get_table_information(cur, conn) -> tuple[set[str], set[tuple[set[str, str]]]]:
     """
     Return the general table and column information.
@@ -49,8 +113,7 @@ def get_table_information(cur, conn) -> tuple[set[str], set[tuple[set[str, str]]
     """
     meta_query = fetch_meta_data()
     print(meta_query)
-    cur.execute(meta_query)
-    conn.commit()
+    query_log.execute(cur, meta_query)
     tables = set()
     table_column_pairs = set()
     for meta_result in cur.fetchall():
@@ -60,75 +123,332 @@ def get_table_information(cur, conn) -> tuple[set[str], set[tuple[set[str, str]]
     return tables, table_column_pairs
 
 
-def run_count_check(tables, cur, conn, report_writer):
+def get_table_columns(cur, conn) -> dict:
     """
-    Perform the 'Count Check' on the provided table.
-    Write the result of the check to `report_writer`.
-    :param tables: The table to run the check on
     :param cur: The database cursor
     :param conn: The database connection
+    :return: dict of table name to its columns, both sorted, so the reports are stable,
+      without the `bookkeeping_tables`
+    """
+    tables, table_column_pairs = get_table_information(cur, conn)
+    return {table: sorted(column for pair_table, column in table_column_pairs if pair_table == table)
+            for table in sorted(tables - bookkeeping_tables)}
+
+
+def run_table_check(table, columns, cur) -> dict:
+    """
+    Run the single scan check of one table.
+    :param table: The table to check
+    :param columns: The columns of the table
+    :param cur: The database cursor
+    :return: dict with the row `count`, the `non_null` count per column and the key `duplicates` (None without key)
+    """
+    key = table_keys.get(table)
+    query_log.execute(cur, table_check(table, columns, key))
+    result = cur.fetchone()
+    return {
+        "count": result[0],
+        "non_null": dict(zip(columns, result[1:len(columns) + 1])),
+        "duplicates": result[-1] if key is not None else None,
+    }
+
+
+def run_table_checks(table_columns, cur) -> dict:
+    """
+    Check all tables one after another, on a single connection.
+    :param table_columns: dict of table name to its columns
+    :param cur: The database cursor
+    :return: dict of table name to the result of `run_table_check`
+    """
+    results = {}
+    for table, columns in table_columns.items():
+        print(f"Checking {table}")
+        results[table] = run_table_check(table, columns, cur)
+    return results
+
+
+def run_table_checks_parallel(table_columns, connection_pool, workers) -> dict:
+    """
+    Check the tables concurrently, every table on its own connection.
+    :param table_columns: dict of table name to its columns
+    :param connection_pool: the database.ConnectionPool, with at least `workers` connections
+    :param workers: number of tables checked at the same time
+    :return: dict of table name to the result of `run_table_check`
+    """
+    def check(table):
+        print(f"Checking {table}")
+        conn = connection_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                return run_table_check(table, table_columns[table], cur)
+        finally:
+            # the pool ends the read transaction
+            connection_pool.putconn(conn)
+
+    with ThreadPoolExecutor(workers) as executor:
+        return dict(zip(table_columns, executor.map(check, table_columns)))
+
+
+def run_count_check(results, report_writer):
+    """
+    Write the result of the 'Count Check' to `report_writer`.
+    :param results: dict of table name to the result of `run_table_check`
     :param report_writer: The writer object where to write the markdown to
     :returns: None
     """
-    print("Running Check 'Count on Tables'")
     report_writer.write(f"# Count Check\n")
     report_writer.write(f"|Table|Count|Passed|\n")
     report_writer.write(f"|-----|-----|------|\n")
-    for table in tables:
-        count_table_query = count_check(table)
-        cur.execute(count_table_query)
-        conn.commit()
-        count = cur.fetchone()[0]
+    for table, result in results.items():
+        count = result["count"]
         report_writer.write(f"|{table}|{count}|{count != 0}|\n")
 
 
-def run_null_check(table_column_pairs, cur, conn, report_writer):
+def run_unique_check(results, report_writer):
+    """
+    Write the result of the 'Unique Check' on the keys of the star schema tables to `report_writer`.
+    :param results: dict of table name to the result of `run_table_check`
+    :param report_writer: The writer object where to write the markdown to
+    :returns: None
+    """
+    report_writer.write(f"# Unique Check\n")
+    report_writer.write(f"|Table|Key|Duplicates|Passed|\n")
+    report_writer.write(f"|-----|---|----------|------|\n")
+    for table, result in results.items():
+        duplicates = result["duplicates"]
+        if duplicates is not None:
+            key = table_keys[table]
+            key = key if isinstance(key, str) else ", ".join(key)
+            report_writer.write(f"|{table}|{key}|{duplicates}|{duplicates == 0}|\n")
+
+
+def run_null_check(results, report_writer):
     """
-    Perform the 'Null Check' on the provided table.
-    Write the result of the check to `report_writer`.
-    :param table_column_pairs: tuple,
-      * where first element is the table name and
-      * second element is the column name
-    :param cur: the database cursor
-    :param conn: the database connection
+    Write the result of the 'Null Check' to `report_writer`.
+    :param results: dict of table name to the result of `run_table_check`
     :param report_writer: The writer object where to write the markdown to
     :returns: None
     """
-    print("Running Check 'Null on Columns'")
     report_writer.write(f"# Null Check\n")
     report_writer.write(f"|Table|Column|Null|Non-Null|Passed|\n")
     report_writer.write(f"|-----|------|----|--------|------|\n")
-    for table_colum_pair in table_column_pairs:
-        table_name, column_name = table_colum_pair
-        null_check_query = null_check(table_name, column_name)
-        cur.execute(null_check_query)
-        conn.commit()
-        null_count, non_null_count = cur.fetchone()
-        total = null_count + non_null_count
-        # more than 20% null is bad data quality
-        report_writer.write(f"|{table_name}|{column_name}|{null_count}|{non_null_count}|{null_count * 0.2 < total}|\n")
+    for table_name, result in results.items():
+        total = result["count"]
+        for column_name, non_null_count in result["non_null"].items():
+            null_count = total - non_null_count
+            # more than 20% null is bad data quality
+            report_writer.write(f"|{table_name}|{column_name}|{null_count}|{non_null_count}|{null_count * 0.2 < total}|\n")
 
 
-def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+def last_increment(table, cur):
+    """
+    :param table: The profiled table
+    :param cur: The database cursor
+    :return: the increment column value up to which the table was profiled last time, None if it never was
+    """
+    query_log.execute(cur, "SELECT increment_to FROM dq_history WHERE table_name = %s AND increment_to IS NOT NULL "
+                           "ORDER BY profiled_at DESC LIMIT 1;", (table,))
+    result = cur.fetchone()
+    return result[0] if result else None
 
-    host = config.get("CLUSTER", "host")
-    db_name = config.get("CLUSTER", "db_name")
-    db_user = config.get("CLUSTER", "db_user")
-    db_password = config.get("CLUSTER", "db_password")
-    db_port = config.get("CLUSTER", "db_port")
 
-    conn = psycopg2.connect(f"host={host} dbname={db_name} user={db_user} password={db_password} port={db_port}")
-    cur = conn.cursor()
-    tables, table_column_pairs = get_table_information(cur, conn)
+def profile_table(table, columns, numeric_columns, cur, sample_fraction=1.0, incremental=False) -> list[dict]:
+    """
+    Profile the columns of a table.
+    In incremental mode, only the rows loaded after the last profile of the table are read.
+    :param table: The table to profile
+    :param columns: The columns of the table
+    :param numeric_columns: The columns that get percentiles
+    :param cur: The database cursor
+    :param sample_fraction: share of the rows that is sampled, 1 reads all rows
+    :param incremental: only profile the new rows of the tables in `increment_columns`
+    :return: the profile of every column as a dict with the keys of `profile_columns`, empty if there are no new rows
+    """
+    increment_from = None
+    increment_to = None
+    increment_column = increment_columns.get(table)
+    if increment_column is not None:
+        if incremental:
+            increment_from = last_increment(table, cur)
+        # the high water mark is taken from all new rows, not from the sample
+        where, parameters = profile_filter(table, 1, increment_from)
+        query_log.execute(cur, f'SELECT MAX("{increment_column}") FROM {table}{where};', parameters)
+        increment_to = cur.fetchone()[0]
+        if increment_to is None:
+            print(f"No new rows in {table} since {increment_from}")
+            return []
+        increment_to = str(increment_to)
+
+    where, parameters = profile_filter(table, sample_fraction, increment_from)
+    query_log.execute(cur, profile_query(table, columns, numeric_columns, where), parameters)
+    result = iter(cur.fetchone())
+    row_count = next(result)
+    profiles = []
+    for column in columns:
+        non_null_count, distinct_count, min_value, max_value = (next(result) for _ in range(4))
+        p50, p95 = None, None
+        if column in numeric_columns:
+            p50, p95 = (float(value) if value is not None else None for value in (next(result), next(result)))
+        profiles.append({
+            "table_name": table,
+            "column_name": column,
+            "sample_fraction": sample_fraction,
+            "row_count": row_count,
+            "null_count": row_count - non_null_count,
+            "distinct_count": distinct_count,
+            "min_value": str(min_value)[:256] if min_value is not None else None,
+            "max_value": str(max_value)[:256] if max_value is not None else None,
+            "p50": p50,
+            "p95": p95,
+            "increment_from": increment_from,
+            "increment_to": increment_to,
+        })
+    return profiles
 
-    with open("data-quality-report.md", 'wt') as report_writer:
+
+def previous_null_shares(cur) -> dict:
+    """
+    The null share of every column in the latest profile of its table, to compare a new profile with.
+    :param cur: The database cursor
+    :return: dict of (table, column) to the share of null values, between 0 and 1
+    """
+    query_log.execute(cur, """
+    SELECT history.table_name, history.column_name, history.null_count, history.row_count 
+    FROM dq_history history 
+    JOIN (SELECT table_name, MAX(profiled_at) AS profiled_at FROM dq_history GROUP BY table_name) latest 
+      ON history.table_name = latest.table_name AND history.profiled_at = latest.profiled_at
+    """)
+    return {(table, column): null_count / row_count
+            for table, column, null_count, row_count in cur.fetchall() if row_count}
+
+
+def save_profile(cur, profiled_at, profiles):
+    """
+    Append the profiles to dq_history, with a single insert.
+    :param cur: The database cursor
+    :param profiled_at: the timestamp of this run, shared by all of its rows
+    :param profiles: the column profiles of `profile_table`
+    :returns: None
+    """
+    rows = [tuple([profiled_at] + [profile[column] for column in profile_columns[1:]]) for profile in profiles]
+    psycopg2.extras.execute_values(
+        cur, f"INSERT INTO dq_history ({', '.join(profile_columns)}) VALUES %s", rows, page_size=max(1, len(rows)))
+
+
+def write_profile_report(profiles, previous, report_writer):
+    """
+    Write the profiles as markdown to `report_writer`, with the null share of the previous profile.
+    :param profiles: the column profiles of `profile_table`
+    :param previous: the null shares of `previous_null_shares`
+    :param report_writer: The writer object where to write the markdown to
+    :returns: None
+    """
+    report_writer.write(f"# Profile\n")
+    report_writer.write(f"|Table|Column|Rows|Null %|Previous Null %|Distinct (approx.)|Min|Max|P50|P95|Increment|\n")
+    report_writer.write(f"|-----|------|----|------|---------------|------------------|---|---|---|---|---------|\n")
+    for profile in profiles:
+        table, column = profile["table_name"], profile["column_name"]
+        row_count = profile["row_count"]
+        null_share = f"{profile['null_count'] / row_count:.1%}" if row_count else ""
+        previous_share = f"{previous[(table, column)]:.1%}" if (table, column) in previous else ""
+        increment = f"{profile['increment_from'] or ''} - {profile['increment_to']}" if profile["increment_to"] else ""
+        report_writer.write(f"|{table}|{column}|{row_count}|{null_share}|{previous_share}|{profile['distinct_count']}|"
+                            f"{profile['min_value']}|{profile['max_value']}|{profile['p50']}|{profile['p95']}|"
+                            f"{increment}|\n")
+
+
+def run_profile(table_columns, cur, sample_fraction=1.0, incremental=False, report_path="data-profile-report.md"):
+    """
+    Profile all tables, append the result to dq_history and write it as markdown report.
+    :param table_columns: dict of table name to its columns
+    :param cur: The database cursor
+    :param sample_fraction: share of the rows that is sampled, 1 reads all rows
+    :param incremental: only profile the new rows of the tables in `increment_columns`
+    :param report_path: where the markdown report is written
+    :returns: None
+    """
+    query_log.execute(cur, dq_history_table_create)
+    query_log.execute(cur, fetch_numeric_columns())
+    numeric_columns = set(cur.fetchall())
+    previous = previous_null_shares(cur)
+
+    profiled_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    profiles = []
+    for table, columns in table_columns.items():
+        print(f"Profiling {table}")
+        profiles += profile_table(table, columns, {column for pair_table, column in numeric_columns if pair_table == table},
+                                  cur, sample_fraction, incremental)
+    if profiles:
+        save_profile(cur, profiled_at, profiles)
+
+    with open(report_path, 'wt') as report_writer:
+        report_writer.write(f"# Data Profile {profiled_at.isoformat(timespec='seconds')}\n")
+        report_writer.write(f"Sampled {sample_fraction:.0%} of the rows{', incremental' if incremental else ''}.\n")
+        write_profile_report(profiles, previous, report_writer)
+
+
+def parse_arguments():
+    """
+    Parse the command line options of the data quality checks.
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Check the data quality of all tables.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of tables checked at the same time, each on its own connection (default: 1)")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile the columns into dq_history and data-profile-report.md instead of the checks")
+    parser.add_argument("--sample", type=float, default=1.0,
+                        help="share of the rows read by the profile, between 0 and 1 (default: 1, all rows)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only profile the rows loaded since the last profile")
+    parser.add_argument("--query-log", default="query-log.jsonl",
+                        help="json lines file every executed statement is appended to (default: query-log.jsonl)")
+    return parser.parse_args()
+
+
+def run_checks(connection_pool, workers=1, report_path="data-quality-report.md"):
+    """
+    Run the count, unique and null checks of all tables and write the markdown report.
+    :param connection_pool: the database.ConnectionPool, with at least `workers` connections
+    :param workers: number of tables checked at the same time
+    :param report_path: where the report is written
+    :returns: None
+    """
+    conn = connection_pool.getconn()
+    try:
+        table_columns = get_table_columns(conn.cursor(), conn)
+        print("Running Checks 'Count on Tables', 'Unique Keys' and 'Null on Columns'")
+        if workers <= 1:
+            results = run_table_checks(table_columns, conn.cursor())
+    finally:
+        connection_pool.putconn(conn)
+    if workers > 1:
+        results = run_table_checks_parallel(table_columns, connection_pool, workers)
+
+    with open(report_path, 'wt') as report_writer:
         report_writer.write("# Data Quality Report\n")
-        run_count_check(tables, cur, conn, report_writer)
-        run_null_check(table_column_pairs, cur, conn, report_writer)
+        run_count_check(results, report_writer)
+        run_unique_check(results, report_writer)
+        run_null_check(results, report_writer)
 
-    conn.close()
+
+def main():
+    args = parse_arguments()
+    query_log.start("data_quality", args.query_log)
+    connection_pool = database.ConnectionPool(database.load_settings(), max(1, args.workers))
+    try:
+        if args.profile:
+            conn = connection_pool.getconn()
+            try:
+                run_profile(get_table_columns(conn.cursor(), conn), conn.cursor(), args.sample, args.incremental)
+                conn.commit()
+            finally:
+                connection_pool.putconn(conn)
+        else:
+            run_checks(connection_pool, args.workers)
+    finally:
+        connection_pool.closeall()
+        query_log.print_summary()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,221 @@
+# The connections of create_tables.py, etl.py, data_quality.py, pipeline.py, spectrum.py and reports.py to the cluster.
+# Every connection is made with keepalives, an optional statement timeout and retries on transient failures.
+import configparser
+import re
+import time
+from typing import NamedTuple
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from instrumentation import query_log
+
+# SQLSTATEs of a serialization failure and a deadlock, the transaction succeeds when it runs again
+TRANSIENT_PGCODES = {"40001", "40P01"}
+# the message of redshift's serializable isolation violation, like `ERROR: 1023 DETAIL: Serializable isolation ...`
+SERIALIZABLE_ISOLATION_VIOLATION = re.compile(r"\b1023\b")
+
+
+class ConnectionSettings(NamedTuple):
+    """
+    How to connect to the cluster, read from the `[CLUSTER]` section of `dwh.cfg`.
+    """
+    host: str
+    db_name: str
+    db_user: str
+    db_password: str
+    db_port: str
+    # seconds to wait for a connection
+    connect_timeout: int = 10
+    # seconds of silence before the first keepalive probe, long COPYs send nothing while redshift works
+    keepalives_idle: int = 60
+    # seconds a statement may run before redshift cancels it, 0 never cancels
+    statement_timeout: int = 0
+    # attempts after the first one, for connections that fail and statements that hit a transient error
+    retries: int = 3
+    # seconds before the first retry, doubled for every further one
+    retry_backoff: float = 1.0
+
+
+class Connection(psycopg2.extensions.connection):
+    """
+    A psycopg2 connection that knows the settings it was made with, so `execute` can retry its statements.
+    """
+    settings = None
+
+
+def read_settings(config, section="CLUSTER"):
+    """
+    :param config: the parsed `dwh.cfg`
+    :param section: the section with the connection
+    :return: the ConnectionSettings, the optional keys fall back to the defaults
+    """
+    defaults = ConnectionSettings("", "", "", "", "")
+    return ConnectionSettings(
+        config.get(section, "host"),
+        config.get(section, "db_name"),
+        config.get(section, "db_user"),
+        config.get(section, "db_password"),
+        config.get(section, "db_port"),
+        config.getint(section, "connect_timeout", fallback=defaults.connect_timeout),
+        config.getint(section, "keepalives_idle", fallback=defaults.keepalives_idle),
+        config.getint(section, "statement_timeout", fallback=defaults.statement_timeout),
+        config.getint(section, "retries", fallback=defaults.retries),
+        config.getfloat(section, "retry_backoff", fallback=defaults.retry_backoff),
+    )
+
+
+def load_settings(path="dwh.cfg", section="CLUSTER"):
+    """
+    :param path: the config file
+    :param section: the section with the connection
+    :return: the ConnectionSettings
+    """
+    config = configparser.ConfigParser()
+    config.read(path)
+    return read_settings(config, section)
+
+
+def connection_string(settings):
+    """
+    :param settings: the ConnectionSettings
+    :return: the libpq connection string, with connect timeout and keepalives
+    """
+    return (f"host={settings.host} dbname={settings.db_name} user={settings.db_user} "
+            f"password={settings.db_password} port={settings.db_port} connect_timeout={settings.connect_timeout} "
+            f"keepalives=1 keepalives_idle={settings.keepalives_idle} keepalives_interval=10 keepalives_count=6")
+
+
+def is_transient(error):
+    """
+    The error is classified by its SQLSTATE, redshift reports a serializable isolation violation
+    as internal error `1023`, which psycopg2 raises as InternalError.
+    :param error: the error of a failed connect or statement
+    :return: True if the same work may succeed when it is tried again, like after a lost connection,
+      a serialization conflict or a deadlock. A statement cancelled by its timeout is not retried.
+    """
+    if isinstance(error, psycopg2.extensions.QueryCanceledError):
+        return False
+    pgcode = getattr(error, "pgcode", None)
+    if pgcode in TRANSIENT_PGCODES:
+        return True
+    if pgcode == "XX000" and SERIALIZABLE_ISOLATION_VIOLATION.search(str(error)):
+        return True
+    return isinstance(error, psycopg2.OperationalError)
+
+
+def retry_delay(settings, attempt):
+    """
+    :param settings: the ConnectionSettings
+    :param attempt: the number of the failed attempt, starting at 0
+    :return: the seconds to wait before the next attempt
+    """
+    return settings.retry_backoff * 2 ** attempt
+
+
+def connect(settings):
+    """
+    Connect to the cluster and set the statement timeout, retrying failed connects with backoff.
+    :param settings: the ConnectionSettings
+    :return: the Connection
+    """
+    for attempt in range(settings.retries + 1):
+        try:
+            conn = psycopg2.connect(connection_string(settings), connection_factory=Connection)
+        except psycopg2.OperationalError as error:
+            if attempt == settings.retries:
+                raise
+            print(f"Connecting to {settings.host} failed, retrying in {retry_delay(settings, attempt):.1f}s: {error}")
+            time.sleep(retry_delay(settings, attempt))
+            continue
+        conn.settings = settings
+        if settings.statement_timeout > 0:
+            with conn.cursor() as cur:
+                cur.execute(f"SET statement_timeout TO {settings.statement_timeout * 1000};")
+            conn.commit()
+        return conn
+
+
+def execute(cur, conn, query, parameters=None):
+    """
+    Execute and commit a statement through the query log.
+    A transient error is retried on the same connection, after the failed transaction was rolled back.
+    When the connection itself is lost, the error is raised, as the cursor of the caller can not be replaced.
+    :param cur: the database cursor
+    :param conn: the database connection, its settings decide the retries
+    :param query: the statement
+    :param parameters: the query parameters, optional
+    :returns: None
+    """
+    settings = getattr(conn, "settings", None)
+    retries = settings.retries if settings is not None else 0
+    for attempt in range(retries + 1):
+        try:
+            query_log.execute(cur, query, parameters, conn)
+            return
+        except Exception as error:
+            if attempt == retries or not is_transient(error) or conn.closed:
+                raise
+            conn.rollback()
+            print(f"Retrying in {retry_delay(settings, attempt):.1f}s: {str(error).strip()}")
+            time.sleep(retry_delay(settings, attempt))
+
+
+class ConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    A fixed number of connections that are made by `connect` and reused by all steps of a run.
+    psycopg2 closes returned connections above `minconn`, so the pool keeps all of its connections open.
+    """
+
+    def __init__(self, settings, connections=1):
+        """
+        :param settings: the ConnectionSettings
+        :param connections: the number of connections
+        """
+        self.settings = settings
+        super().__init__(connections, connections)
+
+    def _connect(self, key=None):
+        """
+        Make a new connection, like the base class does, but through `connect`.
+        """
+        conn = connect(self.settings)
+        if key is not None:
+            self._used[key] = conn
+            self._rused[id(conn)] = key
+        else:
+            self._pool.append(conn)
+        return conn
+
+
+def execute_pooled(connection_pool, query, parameters=None):
+    """
+    Execute and commit a statement on a connection of the pool.
+    A transient error is retried with backoff, a lost connection is replaced by a new one.
+    :param connection_pool: the ConnectionPool
+    :param query: the statement
+    :param parameters: the query parameters, optional
+    :returns: None
+    """
+    settings = connection_pool.settings
+    for attempt in range(settings.retries + 1):
+        conn = connection_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                query_log.execute(cur, query, parameters, conn)
+        except Exception as error:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    # the connection got lost during the statement, it is closed now
+                    pass
+            connection_pool.putconn(conn, close=bool(conn.closed))
+            if attempt == settings.retries or not is_transient(error):
+                raise
+            print(f"Retrying in {retry_delay(settings, attempt):.1f}s: {str(error).strip()}")
+            time.sleep(retry_delay(settings, attempt))
+            continue
+        connection_pool.putconn(conn)
+        return
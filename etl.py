@@ -1,23 +1,60 @@
+import argparse
 import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
+import database
+from instrumentation import query_log
+from sql_queries import copy_table_queries, copy_manifest_table_queries, copy_parquet_table_queries, \
+    insert_table_queries, insert_table_sources, merge_table_queries, refresh_view_queries, staging_clear_queries, \
+    staging_events_prune
 
-def load_staging_tables(cur, conn, role_s3_read, event_path, songs_path, event_schema_path):
+# COPY option per compression of the files written by combine.py
+COPY_COMPRESSION = {"none": "", "gzip": "GZIP", "zstd": "ZSTD"}
+
+
+def get_copy_queries(load_format):
     """
-    Load the staging tables into redshift.
-    As some parts of the sql statements are dynamic,
-    they are replaced at runtime by this function with the actual values.
+    Select the staging COPY statements for the output of combine.py.
+    :param load_format: `single` for one json file per dataset, `sharded` for shards listed in a manifest,
+      `parquet` for a directory of typed parquet files
+    :returns: list of COPY statements
+    """
+    if load_format == "parquet":
+        return copy_parquet_table_queries
+    if load_format == "sharded":
+        return copy_manifest_table_queries
+    return copy_table_queries
 
+
+def load_staging_tables(cur, conn, queries, incremental=False):
+    """
+    Load the staging tables into redshift.
     :param cur: the database cursor
     :param conn: the database connection
+    :param queries: the prepared COPY statements, see `staging_copy_queries`
+    :param incremental: remove the events from staging that were merged by an earlier run
+    :returns: None
+    """
+    for query in complete_copy_queries(queries, incremental):
+        print(query)
+        database.execute(cur, conn, query)
+
+
+def prepare_copy_queries(queries, role_s3_read, event_path, songs_path, event_schema_path, compression="none"):
+    """
+    Replace the placeholders of the COPY statements with the actual values.
+    :param queries: the COPY statements, see `get_copy_queries`
     :param role_s3_read: the s3 role with read access
     :param event_path: the path to the combined log events on a s3 bucket
     :param songs_path: the path to the combined songs on a s3 bucket
     :param event_schema_path: the path to the log schema
-    :returns: None
+    :param compression: the compression of the loaded files, one of COPY_COMPRESSION
+    :returns: list of ready to run COPY statements
     """
-    for query in copy_table_queries:
+    prepared = []
+    for query in queries:
         if "$iam" in query:
             query = query.replace("$iam", role_s3_read)
         if "$events" in query:
@@ -26,45 +63,183 @@ def load_staging_tables(cur, conn, role_s3_read, event_path, songs_path, event_s
             query = query.replace("$songs", songs_path)
         if "$event_schema" in query:
             query = query.replace("$event_schema", event_schema_path)
-        print(query)
-        cur.execute(query)
-        conn.commit()
+        if "$compression" in query:
+            query = query.replace("$compression", COPY_COMPRESSION[compression])
+        prepared.append(query)
+    return prepared
 
 
-def insert_tables(cur, conn):
+def staging_copy_queries(config, day=None):
+    """
+    The COPY statements of the staging tables for the files configured in the `[AWS]` section of `dwh.cfg`.
+    As some parts of the sql statements are dynamic, they are replaced with the actual values.
+    :param config: the parsed `dwh.cfg`
+    :param day: stage only the events of this day, like `2018-11-30`, optional
+    :returns: list of ready to run COPY statements
+    """
+    role_s3_read = config.get("CLUSTER", "role_s3_read")
+    event_path = config.get("AWS", "log_data")
+    song_path = config.get("AWS", "song_data")
+    event_schema_path = config.get("AWS", "log_schema_path")
+    load_format = config.get("AWS", "load_format", fallback="single")
+    compression = config.get("AWS", "compression", fallback="none")
+    queries = prepare_copy_queries(get_copy_queries(load_format), role_s3_read, event_path, song_path,
+                                   event_schema_path, compression)
+    if day is None:
+        return queries
+
+    # a single day is read from the uncompressed source file of the udacity bucket layout,
+    # the songs are still loaded in the configured format
+    event_year, event_month, event_day = day.split("-")
+    day_path = config.get("AWS", "log_data_day").format(year=event_year, month=event_month, day=event_day)
+    day_queries = prepare_copy_queries(copy_table_queries, role_s3_read, day_path, song_path, event_schema_path)
+    day_copy = next(query for query in day_queries if target_table(query) == "log_data")
+    return [day_copy if target_table(query) == "log_data" else query for query in queries]
+
+
+def insert_tables(cur, conn, queries=insert_table_queries):
     """
     Insert the data into the redshift instance, performed via ELT from the staging tables.
     :param cur: the database cursor
     :param conn: the database connection
+    :param queries: the insert statements, `merge_table_queries` for an incremental run,
+      or `refresh_view_queries` to update the reporting views afterwards
     :returns: None
     """
-    for query in insert_table_queries:
+    for query in queries:
         print(query)
-        cur.execute(query)
-        conn.commit()
+        database.execute(cur, conn, query)
 
 
-def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+def complete_copy_queries(queries, incremental=False):
+    """
+    Add the statements that have to run in the same transaction as the COPY of a staging table:
+    clearing the rows of an earlier run and pruning the already merged events for an incremental run.
+    :param queries: the prepared COPY statements
+    :param incremental: remove the events from staging that were merged by an earlier run
+    :returns: the completed COPY statements
+    """
+    completed = []
+    for query in queries:
+        table = target_table(query)
+        query = staging_clear_queries.get(table, "") + query
+        if incremental and table == "log_data":
+            query += staging_events_prune
+        completed.append(query)
+    return completed
 
-    host = config.get("CLUSTER", "host")
-    db_name = config.get("CLUSTER", "db_name")
-    db_user = config.get("CLUSTER", "db_user")
-    db_password = config.get("CLUSTER", "db_password")
-    db_port = config.get("CLUSTER", "db_port")
-    role_s3_read = config.get("CLUSTER", "role_s3_read")
-    event_path = config.get("AWS", "log_data")
-    song_path = config.get("AWS", "song_data")
-    event_schema_path = config.get("AWS", "log_schema_path")
 
-    conn = psycopg2.connect(f"host={host} dbname={db_name} user={db_user} password={db_password} port={db_port}")
-    cur = conn.cursor()
+def target_table(query):
+    """
+    :param query: a COPY, INSERT or REFRESH statement, or a merge that ends with the insert into its target
+    :returns: the table or view that is written by the statement
+    """
+    return re.findall(r"(?:COPY|INSERT\s+INTO|REFRESH\s+MATERIALIZED\s+VIEW)\s+(\w+)", query, re.IGNORECASE)[-1].lower()
+
+
+def execute_pooled(connection_pool, query, print_lock):
+    """
+    Execute a single statement on a connection of the pool and commit it.
+    :param connection_pool: the database.ConnectionPool
+    :param query: the statement
+    :param print_lock: serializes the output of the concurrent statements
+    :returns: None
+    """
+    with print_lock:
+        print(query)
+    database.execute_pooled(connection_pool, query)
+
+
+def run_scheduled(connection_pool, queries, workers):
+    """
+    Run the COPY and INSERT statements concurrently, as far as their dependencies allow.
+    A statement starts once every table it reads from, see `insert_table_sources`,
+    is no longer written by a pending statement of this run.
+    So the song dimensions are already built while the log events are still loaded.
+    :param connection_pool: the database.ConnectionPool, with at least `workers` connections
+    :param queries: the statements in their sequential order
+    :param workers: the number of statements running at the same time
+    :returns: None
+    """
+    pending = list(queries)
+    running = {}
+    print_lock = threading.Lock()
+    with ThreadPoolExecutor(workers) as executor:
+        while pending or running:
+            unfinished_targets = {target_table(query) for query in pending} | set(running.values())
+            for query in list(pending):
+                sources = insert_table_sources.get(target_table(query), [])
+                if len(running) < workers and not unfinished_targets.intersection(sources):
+                    pending.remove(query)
+                    running[executor.submit(execute_pooled, connection_pool, query, print_lock)] = target_table(query)
+            if not running:
+                raise RuntimeError(f"Circular dependency between {[target_table(query) for query in pending]}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                # re-raises the error of a failed statement, the remaining ones are not started
+                future.result()
+
+
+def parse_arguments():
+    """
+    Parse the command line options of the ELT.
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Load the staging tables and build the star schema.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of statements and connections running at the same time, "
+                             "1 runs all statements one after another (default: 1)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only merge events newer than the last run into the existing tables, "
+                             "instead of inserting everything")
+    parser.add_argument("--day", metavar="YYYY-MM-DD",
+                        help="stage only the events of this day, from the LOG_DATA_DAY location in dwh.cfg")
+    parser.add_argument("--query-log", default="query-log.jsonl",
+                        help="json lines file every executed statement is appended to (default: query-log.jsonl)")
+    return parser.parse_args()
+
 
-    load_staging_tables(cur, conn, role_s3_read, event_path, song_path, event_schema_path)
-    insert_tables(cur, conn)
+def run_etl(connection_pool, config, workers=1, incremental=False, day=None):
+    """
+    Load the staging tables and build the star schema, on the connections of the pool.
+    :param connection_pool: the database.ConnectionPool, with at least `workers` connections
+    :param config: the parsed `dwh.cfg`
+    :param workers: number of statements running at the same time, 1 runs them one after another
+    :param incremental: only merge events newer than the last run into the existing tables
+    :param day: stage only the events of this day, like `2018-11-30`, optional
+    :returns: None
+    """
+    copy_queries = staging_copy_queries(config, day)
+    insert_queries = merge_table_queries if incremental else insert_table_queries
+
+    if workers > 1:
+        copy_queries = complete_copy_queries(copy_queries, incremental)
+        run_scheduled(connection_pool, copy_queries + insert_queries + refresh_view_queries, workers)
+        return
+
+    conn = connection_pool.getconn()
+    try:
+        cur = conn.cursor()
+        load_staging_tables(cur, conn, copy_queries, incremental)
+        insert_tables(cur, conn, insert_queries)
+        insert_tables(cur, conn, refresh_view_queries)
+    finally:
+        connection_pool.putconn(conn)
+
+
+def main():
+    args = parse_arguments()
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
 
-    conn.close()
+    query_log.start("etl", args.query_log)
+    connection_pool = database.ConnectionPool(database.read_settings(config), max(1, args.workers))
+    try:
+        run_etl(connection_pool, config, args.workers, args.incremental, args.day)
+    finally:
+        connection_pool.closeall()
+        query_log.print_summary()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+# The in-memory form of a log event, for the outputs of combine.py that hold the parsed records,
+# like the parquet files and the validation. A dict per event takes about 2 KB with its values,
+# an EventRecord about 300 bytes: a slot per key instead of a hash table, and the strings that repeat
+# between the events of a log file are stored once. The numeric keys are typed when the record is built,
+# so a batch of records turns into columns without a conversion per value.
+import sys
+from typing import Optional, Union
+
+# the keys of a udacity log event, in the order of the log files
+EVENT_KEYS = ("artist", "auth", "firstName", "gender", "itemInSession", "lastName", "length", "level", "location",
+              "method", "page", "registration", "sessionId", "song", "status", "ts", "userAgent", "userId")
+# the date of the log file, added by combine.py
+DATE_KEYS = ("event_day", "event_month", "event_year")
+RECORD_KEYS = EVENT_KEYS + DATE_KEYS
+_RECORD_KEY_SET = frozenset(RECORD_KEYS)
+# a value as parsed from the json, the log files are not typed: a `song` may as well be a number
+JsonValue = Union[None, bool, int, float, str, list, dict]
+# the numeric keys and their python type, converted like `combine.convert_value` when the record is built
+TYPED_KEYS = {"itemInSession": int, "length": float, "sessionId": int, "status": int, "ts": int}
+
+
+class EventRecord:
+    """
+    One log event with a slot per key, read like a dict with `get`.
+    The slots of TYPED_KEYS hold the converted value, None if the json value can not be converted.
+    A json value of another type, like a text `sessionId`, is kept in `raw`,
+    so `get` and `to_dict` return the json and the validation still sees the text.
+    Keys that are missing in the json stay unset and are left out by `to_dict` again,
+    keys unknown to the udacity logs are kept in `extra`.
+    """
+    __slots__ = RECORD_KEYS + ("extra", "raw")
+
+    artist: JsonValue
+    auth: JsonValue
+    firstName: JsonValue
+    gender: JsonValue
+    itemInSession: Optional[int]
+    lastName: JsonValue
+    length: Optional[float]
+    level: JsonValue
+    location: JsonValue
+    method: JsonValue
+    page: JsonValue
+    registration: JsonValue
+    sessionId: Optional[int]
+    song: JsonValue
+    status: Optional[int]
+    ts: Optional[int]
+    userAgent: JsonValue
+    userId: JsonValue
+    event_day: str
+    event_month: str
+    event_year: str
+    extra: Optional[dict]
+    raw: Optional[dict]
+
+    def __init__(self, payload=None):
+        """
+        :param payload: the parsed json event, optional
+        """
+        self.extra = None
+        self.raw = None
+        if payload:
+            self.update(payload)
+
+    def update(self, payload):
+        """
+        Set the keys of the payload.
+        Strings are interned, so the user, session and page values that repeat within a log file are stored once.
+        :param payload: dict of json keys to values
+        :return: None
+        """
+        for key, value in payload.items():
+            if type(value) is str:
+                value = sys.intern(value)
+            if key in _RECORD_KEY_SET:
+                value_type = TYPED_KEYS.get(key)
+                if value_type is not None and value is not None and type(value) is not value_type:
+                    if self.raw is None:
+                        self.raw = {}
+                    self.raw[key] = value
+                    value = typed_value(value, value_type)
+                elif self.raw is not None:
+                    self.raw.pop(key, None)
+                setattr(self, key, value)
+            else:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[key] = value
+
+    def get(self, key, default=None):
+        """
+        :param key: a json key
+        :param default: returned when the event has no such key
+        :return: the json value of the key, like `dict.get`
+        """
+        if key in _RECORD_KEY_SET:
+            if self.raw is not None and key in self.raw:
+                return self.raw[key]
+            return getattr(self, key, default)
+        return self.extra.get(key, default) if self.extra is not None else default
+
+    def to_dict(self):
+        """
+        :return: the event as dict, in the key order of the log files with the date keys last,
+          like the dicts of `combine.read_event_file`
+        """
+        payload = {key: getattr(self, key) for key in EVENT_KEYS if hasattr(self, key)}
+        if self.raw is not None:
+            payload.update(self.raw)
+        if self.extra is not None:
+            payload.update(self.extra)
+        payload.update((key, getattr(self, key)) for key in DATE_KEYS if hasattr(self, key))
+        return payload
+
+    def __reduce__(self):
+        """
+        Pickle the values by position, the worker processes of combine.py send the records back to the main process.
+        """
+        missing = tuple(key for key in RECORD_KEYS if not hasattr(self, key))
+        values = tuple(getattr(self, key, None) for key in RECORD_KEYS)
+        return restore_event_record, (values, missing, self.extra, self.raw)
+
+    def __eq__(self, other):
+        return isinstance(other, EventRecord) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"EventRecord({self.to_dict()!r})"
+
+
+def typed_value(value, value_type):
+    """
+    :param value: a json value that is not of `value_type`
+    :param value_type: the type of the key in TYPED_KEYS
+    :return: the converted value, None if it is empty or can not be converted
+    """
+    if value == "":
+        return None
+    try:
+        return value_type(value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+def restore_event_record(values, missing, extra, raw):
+    """
+    :param values: the values of RECORD_KEYS
+    :param missing: the keys that are not set
+    :param extra: the keys unknown to the udacity logs, or None
+    :param raw: the json values of the typed keys that differ from their converted value, or None
+    :return: the unpickled EventRecord
+    """
+    record = EventRecord.__new__(EventRecord)
+    for key, value in zip(RECORD_KEYS, values):
+        setattr(record, key, value)
+    for key in missing:
+        delattr(record, key)
+    record.extra = extra
+    record.raw = raw
+    return record
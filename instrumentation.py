@@ -0,0 +1,169 @@
+# Times the statements of etl.py, create_tables.py and data_quality.py,
+# so the statements that dominate the nightly window can be found in the query log and the summary of every run.
+import datetime
+import json
+import re
+import threading
+import time
+import uuid
+
+# the COPY that was just committed on the session, the files and bytes are taken from the system tables of redshift
+COPY_STATISTICS_QUERY = """
+SELECT
+  pg_last_copy_count(),
+  (SELECT COUNT(DISTINCT filename) FROM stl_load_commits WHERE query = pg_last_copy_id()),
+  (SELECT SUM(bytes) FROM stl_file_scan WHERE query = pg_last_copy_id());
+"""
+
+# the table of a statement is the first name after one of these keywords
+STATEMENT_TARGET = re.compile(r"\b(?:COPY|INTO|TABLE|VIEW|UPDATE|FROM)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)",
+                              re.IGNORECASE)
+# a COPY is recorded as such, also after the statements that prepare its transaction
+COPY_STATEMENT = re.compile(r"^\s*COPY\s+(\w+)", re.IGNORECASE | re.MULTILINE)
+# a DELETE after the COPY in its transaction, like `staging_events_prune`, the cursor reports its rows
+PRUNE_STATEMENT = re.compile(r"^\s*COPY\b.*^\s*DELETE\s+FROM\b", re.IGNORECASE | re.MULTILINE | re.DOTALL)
+
+
+def describe_statement(query):
+    """
+    :param query: the statement, a COPY may be preceded and followed by further statements of its transaction
+    :return: tuple of the kind of the statement, like `COPY` or `INSERT`, and the table it works on
+    """
+    copy = COPY_STATEMENT.search(query)
+    if copy:
+        return "COPY", copy.group(1).lower()
+    words = query.split()
+    kind = words[0].upper() if words else ""
+    target = STATEMENT_TARGET.search(query)
+    return kind, target.group(1).lower() if target else ""
+
+
+class QueryLog:
+    """
+    Executes statements and records their wall time, the affected rows and for a COPY the loaded rows, files and bytes,
+    and the rows pruned by a DELETE that follows it.
+    Every statement is appended as a json line to the log file of the run.
+    The executions may come from several threads, like the concurrent statements of etl.py.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.run_id = None
+        self.script = None
+        self.log_path = None
+        self.statements = []
+        # unknown until the first COPY, postgres has no STL tables
+        self.copy_statistics_available = None
+
+    def start(self, script, log_path="query-log.jsonl"):
+        """
+        Start a new run, the statements of former runs are no longer part of the summary.
+        :param script: the name of the running script, like `etl`
+        :param log_path: the json lines file the statements are appended to, None to only keep them in memory
+        :returns: None
+        """
+        with self.lock:
+            self.run_id = uuid.uuid4().hex[:12]
+            self.script = script
+            self.log_path = log_path
+            self.statements = []
+
+    def execute(self, cur, query, parameters=None, conn=None):
+        """
+        Execute and record a statement.
+        :param cur: the database cursor
+        :param query: the statement
+        :param parameters: the query parameters, optional
+        :param conn: the database connection, if given the statement is committed and counts into the wall time
+        :returns: None
+        """
+        kind, target = describe_statement(query)
+        record = {
+            "run": self.run_id,
+            "script": self.script,
+            "kind": kind,
+            "target": target,
+            "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+        }
+        start = time.perf_counter()
+        try:
+            cur.execute(query, parameters)
+            if conn is not None:
+                conn.commit()
+        except Exception as error:
+            record.update(seconds=round(time.perf_counter() - start, 3), error=str(error).strip())
+            self.record(record)
+            raise
+        record["seconds"] = round(time.perf_counter() - start, 3)
+        record["rows"] = cur.rowcount if cur.rowcount is not None and cur.rowcount >= 0 else None
+        if kind == "COPY" and PRUNE_STATEMENT.search(query):
+            # the rows of the last statement are the pruned ones, not the loaded ones
+            record["pruned"] = record["rows"]
+            record["rows"] = None
+        if kind == "COPY" and conn is not None:
+            record.update(self.copy_statistics(cur, conn))
+        self.record(record)
+
+    def copy_statistics(self, cur, conn):
+        """
+        :param cur: the cursor that committed the COPY
+        :param conn: the database connection
+        :return: dict with the loaded `rows`, `files` and `bytes`, empty if the database does not know them
+        """
+        if self.copy_statistics_available is False:
+            return {}
+        try:
+            cur.execute(COPY_STATISTICS_QUERY)
+            rows, files, loaded_bytes = cur.fetchone()
+        except Exception:
+            # the COPY is already committed, only the failed statistics query is rolled back
+            conn.rollback()
+            self.copy_statistics_available = False
+            return {}
+        self.copy_statistics_available = True
+        return {"rows": rows, "files": files, "bytes": int(loaded_bytes) if loaded_bytes is not None else None}
+
+    def record(self, record):
+        """
+        Keep the record for the summary, append it to the log file and print its duration.
+        :param record: the executed statement
+        :returns: None
+        """
+        with self.lock:
+            self.statements.append(record)
+            if self.log_path is not None:
+                with open(self.log_path, "at") as log_writer:
+                    log_writer.write(json.dumps(record) + "\n")
+            rows = f", {record['rows']} rows" if record.get("rows") is not None else ""
+            pruned = f", {record['pruned']} pruned" if record.get("pruned") is not None else ""
+            print(f"-- {record['kind']} {record['target']} {record['seconds']:.3f}s{rows}{pruned}")
+
+    def summary(self):
+        """
+        :return: the statements of the run as markdown table, the slowest first
+        """
+        lines = ["|Statement|Seconds|Rows|Files|MB|", "|---------|-------|----|-----|--|"]
+        with self.lock:
+            statements = sorted(self.statements, key=lambda record: record["seconds"], reverse=True)
+        for record in statements:
+            loaded_bytes = record.get("bytes")
+            megabytes = f"{loaded_bytes / 1024 / 1024:.1f}" if loaded_bytes is not None else ""
+            failed = " (failed)" if "error" in record else ""
+            lines.append(f"|{record['kind']} {record['target']}{failed}|{record['seconds']:.3f}|"
+                         f"{record.get('rows') if record.get('rows') is not None else ''}|"
+                         f"{record.get('files') if record.get('files') is not None else ''}|{megabytes}|")
+        total = sum(record["seconds"] for record in statements)
+        lines.append(f"|total|{total:.3f}||||")
+        return "\n".join(lines) + "\n"
+
+    def print_summary(self):
+        """
+        Print the summary of the run.
+        :returns: None
+        """
+        print(f"## Statements of {self.script} run {self.run_id}")
+        print(self.summary())
+
+
+# shared by the statements of a process, see `QueryLog.start`
+query_log = QueryLog()
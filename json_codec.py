@@ -0,0 +1,92 @@
+import functools
+import json
+from typing import Callable, NamedTuple
+
+
+class Codec(NamedTuple):
+    """
+    A json implementation used by combine.py.
+    `dumps` always returns a `str`, so the codecs can be exchanged without touching the writers.
+    """
+    name: str
+    loads: Callable
+    dumps: Callable
+
+
+def stdlib_codec() -> Codec:
+    """
+    :return: the codec of the python standard library, always available
+    """
+    return Codec("json", json.loads, json.dumps)
+
+
+def orjson_codec() -> Codec:
+    """
+    orjson parses and serializes in rust, several times faster than the standard library.
+    Its output is compact and keeps non ascii characters as utf-8.
+    :return: the orjson codec, raises ImportError if the package is not installed
+    """
+    import orjson
+    return Codec("orjson", orjson.loads, lambda value: orjson.dumps(value).decode("utf-8"))
+
+
+def simdjson_codec() -> Codec:
+    """
+    pysimdjson only speeds up parsing, serializing falls back to the standard library.
+    :return: the simdjson codec, raises ImportError if the package is not installed
+    """
+    import simdjson
+    return Codec("simdjson", simdjson.loads, json.dumps)
+
+
+# codecs in order of preference for `auto`
+CODEC_FACTORIES = {
+    "orjson": orjson_codec,
+    "simdjson": simdjson_codec,
+    "json": stdlib_codec,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_codec(name: str = "auto") -> Codec:
+    """
+    Resolve a codec by name.
+    `auto` picks the fastest installed codec and falls back to the standard library.
+    :param name: `auto` or one of CODEC_FACTORIES
+    :return: the codec
+    """
+    if name != "auto":
+        return CODEC_FACTORIES[name]()
+    for factory in CODEC_FACTORIES.values():
+        try:
+            return factory()
+        except ImportError:
+            continue
+    return stdlib_codec()
+
+
+def event_date_suffix(event_year: str, event_month: str, event_day: str) -> str:
+    """
+    The json fragment that `splice_fields` appends to every event of a file.
+    :return: the fragment, closing the json object
+    """
+    return f', "event_day": "{event_day}", "event_month": "{event_month}", "event_year": "{event_year}"}}'
+
+
+def splice_fields(line: str, suffix: str) -> str:
+    """
+    Append fields to a raw json object line, without decoding and encoding it again.
+    The closing brace of the object is replaced by `suffix`, which has to close the object again.
+    The line is not validated, this is only safe for input that is known to hold one object per line.
+    :param line: one json object, optionally followed by whitespace
+    :param suffix: the fields to add, starting with a comma, see `event_date_suffix`
+    :return: the extended json object, without trailing newline
+    """
+    line = line.rstrip()
+    if not line.endswith("}"):
+        raise ValueError(f"Not a json object: {line[:80]}")
+    body = line[:-1].rstrip()
+    if body.endswith("{"):
+        # empty object, there is no field before the new ones that needs a separating comma
+        return body + suffix.lstrip(", ")
+    return body + suffix
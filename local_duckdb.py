@@ -0,0 +1,178 @@
+# Runs the ELT of etl.py and the checks of data_quality.py in an embedded DuckDB, on the combined files.
+# There is no server to set up, so the star schema of the sample data is built in about a second, also in CI.
+import argparse
+import re
+import sys
+import time
+
+from combine import EVENT_COLUMNS, SONG_COLUMNS
+from data_quality import get_table_columns, run_count_check, run_null_check, run_table_checks, \
+    run_unique_check
+from local_postgres import REDSHIFT_TO_POSTGRES
+from sql_queries import create_table_queries, drop_table_queries, insert_table_queries
+
+# redshift's FNV_HASH does not exist in duckdb, its own 64 bit hash folded into a BIGINT serves the same purpose
+FNV_HASH_MACRO = "CREATE OR REPLACE MACRO fnv_hash(value) AS CAST(HASH(value) % 9223372036854775807 AS BIGINT);"
+
+# generates the IDENTITY column of fact_songplays, duckdb has no identity columns
+IDENTITY_SEQUENCE = "CREATE OR REPLACE SEQUENCE identity_sequence START 0 MINVALUE 0;"
+
+# DuckDB types of the column types of combine.py
+DUCKDB_TYPES = {"string": "VARCHAR", "int32": "INTEGER", "int64": "BIGINT"}
+
+# duckdb only syntax, applied in order before REDSHIFT_TO_POSTGRES
+REDSHIFT_TO_DUCKDB = [
+    # DATEADD(SECOND, x, '1970-01-01'::DATE) -> '1970-01-01'::DATE + TO_SECONDS(x)
+    # `/` is no integer division in duckdb, the seconds are truncated like redshift does
+    (re.compile(r"DATEADD\(\s*SECOND\s*,\s*([^,]+?)\s*,\s*('[^']*'::DATE)\s*\)", re.IGNORECASE),
+     r"(\2 + TO_SECONDS(CAST(TRUNC(\1) AS BIGINT)))"),
+    (re.compile(r"\bBIGINT\s+IDENTITY\(\s*\d+\s*,\s*\d+\s*\)", re.IGNORECASE),
+     "BIGINT DEFAULT NEXTVAL('identity_sequence')"),
+    # a plain view is always up to date, so REFRESH is never needed
+    (re.compile(r"\bMATERIALIZED\s+VIEW\b", re.IGNORECASE), "VIEW"),
+]
+
+
+def translate_query(query):
+    """
+    Translate a redshift statement from sql_queries.py to duckdb.
+    :param query: the redshift statement
+    :return: the duckdb statement
+    """
+    for pattern, replacement in REDSHIFT_TO_DUCKDB + REDSHIFT_TO_POSTGRES:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def import_duckdb():
+    """
+    duckdb is only needed for the local runs, so it is imported on demand.
+    :return: the duckdb module
+    """
+    try:
+        import duckdb
+    except ImportError:
+        raise RuntimeError("the local engine requires the 'duckdb' package: pip3 install duckdb")
+    return duckdb
+
+
+def connect(database=":memory:"):
+    """
+    Open the database as catalog `dwh` with the schema `public`, where data_quality.py looks for the tables.
+    :param database: the database file, by default everything is kept in memory
+    :return: the duckdb connection, which is also used as cursor
+    """
+    duckdb = import_duckdb()
+    conn = duckdb.connect()
+    conn.execute(f"ATTACH '{database}' AS dwh;")
+    conn.execute("CREATE SCHEMA IF NOT EXISTS dwh.public;")
+    conn.execute("USE dwh.public;")
+    return conn
+
+
+def column_expression(json_key, column_type):
+    """
+    Type a json field like `convert_value` of combine.py, empty strings in numeric columns become null.
+    :param json_key: the key in the json records
+    :param column_type: type of a column in EVENT_COLUMNS or SONG_COLUMNS
+    :return: the select expression
+    """
+    if column_type == "string":
+        return f'"{json_key}"'
+    duckdb_type = DUCKDB_TYPES.get(column_type, column_type.upper())
+    return f"""CAST(NULLIF("{json_key}", '') AS {duckdb_type})"""
+
+
+def load_json_lines(conn, path, table, columns):
+    """
+    Load a combined json file into a staging table with duckdb's own json reader.
+    All fields are read as text and typed like the parquet output of combine.py.
+    :param conn: the duckdb connection
+    :param path: the combined file, like `events.json`
+    :param table: the staging table
+    :param columns: EVENT_COLUMNS or SONG_COLUMNS
+    :return: the number of loaded rows
+    """
+    json_columns = ", ".join(f"'{json_key}': 'VARCHAR'" for _, json_key, _ in columns)
+    expressions = ", ".join(column_expression(json_key, column_type) for _, json_key, column_type in columns)
+    conn.execute(f"""
+    INSERT INTO {table} ({', '.join(column_name for column_name, _, _ in columns)})
+    SELECT {expressions}
+    FROM read_json('{path}', format = 'newline_delimited', columns = {{{json_columns}}});
+    """)
+    return conn.execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0]
+
+
+def execute_timed(conn, queries):
+    """
+    Translate and execute the statements, printing the duration of each.
+    :param conn: the duckdb connection
+    :param queries: list of redshift statements
+    :returns: None
+    """
+    for query in queries:
+        query = translate_query(query)
+        print(query)
+        start = time.perf_counter()
+        conn.execute(query)
+        print(f"-- {time.perf_counter() - start:.3f}s")
+
+
+def run_checks(conn, report_writer):
+    """
+    Run the checks of data_quality.py and write the report.
+    :param conn: the duckdb connection
+    :param report_writer: The writer object where to write the markdown to
+    :returns: None
+    """
+    results = run_table_checks(get_table_columns(conn, conn), conn)
+    report_writer.write("# Data Quality Report\n")
+    run_count_check(results, report_writer)
+    run_unique_check(results, report_writer)
+    run_null_check(results, report_writer)
+
+
+def parse_arguments():
+    """
+    Parse the command line options of the local run.
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Run the ELT and the data quality checks in an embedded DuckDB.")
+    parser.add_argument("--events", default="events.json", help="combined log events (default: events.json)")
+    parser.add_argument("--songs", default="songs.json", help="combined songs (default: songs.json)")
+    parser.add_argument("--database", default=":memory:",
+                        help="database file to keep the tables in (default: in memory)")
+    parser.add_argument("--report", default="-",
+                        help="where the data quality report is written, - for stdout (default: -)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    run_start = time.perf_counter()
+    conn = connect(args.database)
+
+    execute_timed(conn, [FNV_HASH_MACRO, IDENTITY_SEQUENCE])
+    execute_timed(conn, drop_table_queries)
+    execute_timed(conn, create_table_queries)
+
+    for path, table, columns in [(args.events, "log_data", EVENT_COLUMNS), (args.songs, "song_data", SONG_COLUMNS)]:
+        start = time.perf_counter()
+        count = load_json_lines(conn, path, table, columns)
+        seconds = time.perf_counter() - start
+        print(f"-- loaded {count} rows from {path} into {table} in {seconds:.3f}s, {count / seconds:.0f} rows/s")
+
+    execute_timed(conn, insert_table_queries)
+
+    if args.report == "-":
+        run_checks(conn, sys.stdout)
+    else:
+        with open(args.report, 'wt') as report_writer:
+            run_checks(conn, report_writer)
+
+    conn.close()
+    print(f"-- finished in {time.perf_counter() - run_start:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# Runs the staging load and the ELT of etl.py against a local PostgreSQL instead of redshift.
+# This allows measuring the load and transformation on a laptop, without S3, IAM roles or a cluster.
+import argparse
+import configparser
+import io
+import json
+import re
+import time
+
+import psycopg2
+
+from combine import EVENT_COLUMNS, SONG_COLUMNS, convert_value
+from sql_queries import create_table_queries, drop_table_queries, insert_table_queries, refresh_view_queries
+
+# redshift's FNV_HASH does not exist in postgres, a 64 bit slice of MD5 serves the same purpose locally
+FNV_HASH_FUNCTION = """
+CREATE OR REPLACE FUNCTION fnv_hash(value TEXT) RETURNS BIGINT AS $$
+    SELECT ('x' || SUBSTR(MD5(value), 1, 16))::BIT(64)::BIGINT
+$$ LANGUAGE SQL IMMUTABLE;
+"""
+
+# number of rows sent with one COPY FROM STDIN
+COPY_BATCH_SIZE = 50000
+
+# redshift only syntax, rewritten to the postgres equivalent, applied in order
+REDSHIFT_TO_POSTGRES = [
+    # DATEADD(SECOND, x, '1970-01-01'::DATE) -> '1970-01-01'::DATE + x * INTERVAL '1 second'
+    (re.compile(r"DATEADD\(\s*SECOND\s*,\s*([^,]+?)\s*,\s*('[^']*'::DATE)\s*\)", re.IGNORECASE),
+     r"(\2 + (\1) * INTERVAL '1 second')"),
+    (re.compile(r"\bBIGINT\s+IDENTITY\(\s*\d+\s*,\s*\d+\s*\)", re.IGNORECASE), "BIGINT GENERATED BY DEFAULT AS IDENTITY"),
+    # postgres calls the day of week DOW
+    (re.compile(r"EXTRACT\(\s*WEEKDAY\s+FROM", re.IGNORECASE), "EXTRACT(DOW FROM"),
+    (re.compile(r"\bGETDATE\(\)", re.IGNORECASE), "NOW()"),
+    # postgres only counts distinct values and computes percentiles exactly
+    (re.compile(r"\bAPPROXIMATE\s+(?=(?:COUNT|PERCENTILE_DISC)\s*\()", re.IGNORECASE), ""),
+    # distribution, sort keys and column encodings are redshift concepts
+    (re.compile(r"\s+ENCODE\s+\w+", re.IGNORECASE), ""),
+    (re.compile(r"\s*DISTSTYLE\s+\w+", re.IGNORECASE), ""),
+    (re.compile(r"\s*DISTKEY\s*\([^)]*\)", re.IGNORECASE), ""),
+    (re.compile(r"\s*(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)", re.IGNORECASE), ""),
+    (re.compile(r"\s+DISTKEY\b", re.IGNORECASE), ""),
+    # postgres views are only refreshed explicitly
+    (re.compile(r"\s+AUTO\s+REFRESH\s+(?:YES|NO)\b", re.IGNORECASE), ""),
+]
+
+
+def translate_query(query):
+    """
+    Translate a redshift statement from sql_queries.py to postgres.
+    :param query: the redshift statement
+    :return: the postgres statement
+    """
+    for pattern, replacement in REDSHIFT_TO_POSTGRES:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def copy_value(value):
+    """
+    Format a value for the text format of COPY.
+    :param value: the python value
+    :return: the escaped value, `\\N` for null
+    """
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_rows(cur, table, column_names, rows):
+    """
+    Send the rows with a single COPY FROM STDIN.
+    :param cur: the database cursor
+    :param table: the target table
+    :param column_names: the columns of the rows
+    :param rows: list of tuples
+    :returns: None
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(copy_value(value) for value in row) + "\n")
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(column_names)}) FROM STDIN", buffer)
+
+
+def load_json_lines(cur, conn, path, table, columns, batch_size=COPY_BATCH_SIZE):
+    """
+    Stream a combined json file into a staging table, in batches of COPY FROM STDIN.
+    The json keys are mapped and typed like the parquet output of combine.py.
+    :param cur: the database cursor
+    :param conn: the database connection
+    :param path: the combined file, like `events.json`
+    :param table: the staging table
+    :param columns: EVENT_COLUMNS or SONG_COLUMNS
+    :param batch_size: number of rows per COPY
+    :return: the number of loaded rows
+    """
+    column_names = [column_name for column_name, _, _ in columns]
+    count = 0
+    rows = []
+    with open(path, 'rt', encoding='utf-8') as json_reader:
+        for line in json_reader:
+            record = json.loads(line)
+            rows.append(tuple(convert_value(record.get(json_key), column_type) for _, json_key, column_type in columns))
+            if len(rows) >= batch_size:
+                copy_rows(cur, table, column_names, rows)
+                count += len(rows)
+                rows.clear()
+    if rows:
+        copy_rows(cur, table, column_names, rows)
+        count += len(rows)
+    conn.commit()
+    return count
+
+
+def execute_timed(cur, conn, queries):
+    """
+    Translate and execute the statements, printing the duration of each.
+    :param cur: the database cursor
+    :param conn: the database connection
+    :param queries: list of redshift statements
+    :returns: None
+    """
+    for query in queries:
+        query = translate_query(query)
+        print(query)
+        start = time.perf_counter()
+        cur.execute(query)
+        conn.commit()
+        rows = f", {cur.rowcount} rows" if cur.rowcount >= 0 else ""
+        print(f"-- {time.perf_counter() - start:.3f}s{rows}")
+
+
+def parse_arguments():
+    """
+    Parse the command line options of the local run.
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Run the ELT against a local PostgreSQL.")
+    parser.add_argument("--events", default="events.json", help="combined log events (default: events.json)")
+    parser.add_argument("--songs", default="songs.json", help="combined songs (default: songs.json)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    host = config.get("LOCAL", "host", fallback="localhost")
+    db_name = config.get("LOCAL", "db_name", fallback="dwh")
+    db_user = config.get("LOCAL", "db_user", fallback="postgres")
+    db_password = config.get("LOCAL", "db_password", fallback="postgres")
+    db_port = config.get("LOCAL", "db_port", fallback="5432")
+
+    conn = psycopg2.connect(f"host={host} dbname={db_name} user={db_user} password={db_password} port={db_port}")
+    cur = conn.cursor()
+
+    execute_timed(cur, conn, [FNV_HASH_FUNCTION])
+    execute_timed(cur, conn, drop_table_queries)
+    execute_timed(cur, conn, create_table_queries)
+
+    for path, table, columns in [(args.events, "log_data", EVENT_COLUMNS), (args.songs, "song_data", SONG_COLUMNS)]:
+        start = time.perf_counter()
+        count = load_json_lines(cur, conn, path, table, columns)
+        print(f"-- loaded {count} rows from {path} into {table} in {time.perf_counter() - start:.3f}s")
+
+    execute_timed(cur, conn, insert_table_queries)
+    execute_timed(cur, conn, refresh_view_queries)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
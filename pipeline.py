@@ -0,0 +1,61 @@
+# Runs the whole pipeline on the cluster: create the tables, load and transform the data, check its quality.
+# All steps share one pool of connections, instead of every script connecting on its own.
+import argparse
+import configparser
+
+import database
+from create_tables import create_tables, drop_tables
+from data_quality import run_checks
+from etl import run_etl
+from instrumentation import query_log
+
+
+def parse_arguments():
+    """
+    Parse the command line options of the pipeline.
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Create the tables, run the ELT and check the data quality.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of connections, statements and quality checks running at the same time (default: 1)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="keep the existing tables and only merge the events newer than the last run into them")
+    parser.add_argument("--day", metavar="YYYY-MM-DD",
+                        help="stage only the events of this day, from the LOG_DATA_DAY location in dwh.cfg")
+    parser.add_argument("--skip-checks", action="store_true", help="do not run the data quality checks")
+    parser.add_argument("--query-log", default="query-log.jsonl",
+                        help="json lines file every executed statement is appended to (default: query-log.jsonl)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    query_log.start("pipeline", args.query_log)
+    connection_pool = database.ConnectionPool(database.read_settings(config), max(1, args.workers))
+    try:
+        if not args.incremental:
+            print("## Create")
+            conn = connection_pool.getconn()
+            try:
+                cur = conn.cursor()
+                drop_tables(cur, conn)
+                create_tables(cur, conn)
+            finally:
+                connection_pool.putconn(conn)
+
+        print("## Load and transform")
+        run_etl(connection_pool, config, args.workers, args.incremental, args.day)
+
+        if not args.skip_checks:
+            print("## Check")
+            run_checks(connection_pool, args.workers)
+    finally:
+        connection_pool.closeall()
+        query_log.print_summary()
+
+
+if __name__ == "__main__":
+    main()
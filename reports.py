@@ -0,0 +1,64 @@
+# Answers the business questions from the materialized views, that etl.py refreshes after every load.
+import database
+
+
+def top_songs(cur, limit: int = 10) -> list[tuple[str, str, int]]:
+    """
+    What is the most played song?
+    :param cur: the database cursor
+    :param limit: number of songs to return
+    :return: list of (title, artist, plays), the most played song first
+    """
+    cur.execute("SELECT title, artist, plays FROM mv_top_songs ORDER BY plays DESC, title LIMIT %s;", (limit,))
+    return cur.fetchall()
+
+
+def plays_by_time(cur) -> list[tuple[int, int, int]]:
+    """
+    When are songs played?
+    :param cur: the database cursor
+    :return: list of (weekday, hour, plays), ordered by weekday and hour
+    """
+    cur.execute("SELECT weekday, hour, plays FROM mv_plays_by_time ORDER BY weekday, hour;")
+    return cur.fetchall()
+
+
+def plays_by_level(cur) -> list[tuple[str, int, int]]:
+    """
+    How much do free and paid users listen?
+    :param cur: the database cursor
+    :return: list of (level, plays, users)
+    """
+    cur.execute("SELECT level, plays, users FROM mv_plays_by_level ORDER BY level;")
+    return cur.fetchall()
+
+
+def markdown_table(header: list[str], rows: list[tuple]) -> str:
+    """
+    Format the rows like the tables in the README.
+    :param header: the column names
+    :param rows: the result rows
+    :return: the markdown table
+    """
+    lines = ["|" + "|".join(header) + "|", "|" + "|".join("-" * len(name) for name in header) + "|"]
+    for row in rows:
+        lines.append("|" + "|".join(str(value) for value in row) + "|")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    conn = database.connect(database.load_settings())
+    cur = conn.cursor()
+
+    print("## What is the most played song?")
+    print(markdown_table(["song", "artist", "played"], top_songs(cur)))
+    print("## When are songs played?")
+    print(markdown_table(["weekday", "hour", "played"], plays_by_time(cur)))
+    print("## How much do free and paid users listen?")
+    print(markdown_table(["level", "played", "users"], plays_by_level(cur)))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
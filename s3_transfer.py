@@ -0,0 +1,193 @@
+# Moves the data between s3 and combine.py without the manual `aws s3 sync` and upload:
+# the many small objects of the udacity bucket are downloaded concurrently and combined in memory,
+# without a local mirror, and the combined output is uploaded with parallel multipart uploads.
+# Any s3 compatible endpoint works, like a local moto server for offline runs.
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+import boto3
+import botocore.config
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+
+
+class TransferSettings(NamedTuple):
+    """
+    How combine.py talks to s3.
+    """
+    # objects downloaded or parts uploaded at the same time, also the number of connections of the client
+    concurrency: int = 32
+    # files above this size are uploaded in parts, redshift loads the shards of `--output sharded` as whole files
+    multipart_threshold: int = 64 * 1024 * 1024
+    multipart_chunk_size: int = 16 * 1024 * 1024
+    # the s3 endpoint, None for aws
+    endpoint_url: Optional[str] = None
+    region: str = "us-west-2"
+
+
+class S3Object(NamedTuple):
+    """
+    A json object below the prefix of an S3Source, that combine.py reads in place of a local file.
+    """
+    key: str
+    size: int
+    # the content, only set once the object is downloaded
+    body: Optional[bytes] = None
+
+
+def parse_s3_url(url):
+    """
+    :param url: an s3 location, like `s3://udacity-dend/log_data`
+    :return: tuple of bucket and key prefix, the prefix without leading slash
+    """
+    if not url.startswith("s3://"):
+        raise ValueError(f"Not an s3 url: {url}")
+    bucket, _, prefix = url[len("s3://"):].partition("/")
+    return bucket, prefix.lstrip("/")
+
+
+def create_client(settings):
+    """
+    The credentials are taken from the environment, like for the aws cli.
+    :param settings: the TransferSettings
+    :return: the s3 client, with a connection for every concurrent transfer
+    """
+    config = botocore.config.Config(max_pool_connections=settings.concurrency,
+                                    retries={"max_attempts": 10, "mode": "adaptive"})
+    return boto3.client("s3", region_name=settings.region, endpoint_url=settings.endpoint_url, config=config)
+
+
+def list_objects(client, bucket, prefix):
+    """
+    :param client: the s3 client
+    :param bucket: the bucket
+    :param prefix: the key prefix
+    :return: dict of key to the `Size` and `LastModified` of every object below the prefix
+    """
+    objects = {}
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            objects[item["Key"]] = item
+    return objects
+
+
+class S3Source:
+    """
+    The json objects below an s3 prefix, combined by combine.py in place of a local directory.
+    """
+
+    def __init__(self, url, client, settings):
+        """
+        :param url: the s3 location, like `s3://udacity-dend/song_data`
+        :param client: the s3 client of `create_client`
+        :param settings: the TransferSettings
+        """
+        self.url = url
+        self.bucket, self.prefix = parse_s3_url(url)
+        self.client = client
+        self.settings = settings
+
+    def list_files(self):
+        """
+        :return: list of the S3Objects of the json files, without content, in the key order of s3
+        """
+        return [S3Object(key, item["Size"])
+                for key, item in list_objects(self.client, self.bucket, self.prefix).items() if key.endswith(".json")]
+
+    def download(self, s3_object):
+        """
+        :param s3_object: the S3Object to download
+        :return: the S3Object with its content
+        """
+        response = self.client.get_object(Bucket=self.bucket, Key=s3_object.key)
+        return s3_object._replace(body=response["Body"].read())
+
+    def fetch(self, objects):
+        """
+        Download the objects concurrently and stream them in the given order.
+        The downloads run ahead of the consumer by at most twice the concurrency,
+        so only that many objects are held in memory.
+        :param objects: iterable of S3Objects of `list_files`
+        :return: generator of the S3Objects with their content
+        """
+        window = 2 * self.settings.concurrency
+        with ThreadPoolExecutor(self.settings.concurrency) as executor:
+            pending = deque()
+            for s3_object in objects:
+                pending.append(executor.submit(self.download, s3_object))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def local_files(paths):
+    """
+    :param paths: files and directories, directories are walked recursively
+    :return: list of the existing files, paths relative like the given ones
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                files.extend(os.path.join(directory, name) for name in sorted(names))
+        elif os.path.exists(path):
+            files.append(path)
+    return files
+
+
+def object_key(prefix, path):
+    """
+    :param prefix: the key prefix of the upload
+    :param path: the local file, relative to the working directory
+    :return: the key of the file, like in the COPY manifests of combine.py
+    """
+    path = os.path.normpath(path).replace(os.sep, "/")
+    return f"{prefix.rstrip('/')}/{path}" if prefix else path
+
+
+def upload(paths, s3_url, client, settings):
+    """
+    Upload the combined output below `s3_url`, keeping the relative paths.
+    Like `aws s3 sync`, a file is skipped when an object of the same size exists that is not older than the file.
+    Objects in an uploaded directory without a local file are deleted,
+    so a COPY of the directory never loads stale shards of an earlier run.
+    All uploads share one transfer manager, which bounds the concurrent parts.
+    :param paths: the files and directories to upload
+    :param s3_url: the s3 location, like `s3://my-bucket/sparkify`
+    :param client: the s3 client of `create_client`
+    :param settings: the TransferSettings
+    :return: tuple of the number of uploaded, skipped and deleted files
+    """
+    bucket, prefix = parse_s3_url(s3_url)
+    existing = list_objects(client, bucket, prefix)
+    keys = {object_key(prefix, file): file for file in local_files(paths)}
+
+    changed = {}
+    # the modification time of an object is kept in whole seconds
+    for key, file in keys.items():
+        known = existing.get(key)
+        stat = os.stat(file)
+        if known is None or known["Size"] != stat.st_size or known["LastModified"].timestamp() < int(stat.st_mtime):
+            changed[key] = file
+
+    directories = [object_key(prefix, path) + "/" for path in paths if os.path.isdir(path)]
+    stale = [key for key in existing if key not in keys and key.startswith(tuple(directories))] if directories else []
+
+    config = TransferConfig(multipart_threshold=settings.multipart_threshold,
+                            multipart_chunksize=settings.multipart_chunk_size,
+                            max_concurrency=settings.concurrency)
+    print(f"Uploading {len(changed)} files to {s3_url}, {len(keys) - len(changed)} are unchanged")
+    with create_transfer_manager(client, config) as manager:
+        futures = [manager.upload(file, bucket, key) for key, file in changed.items()]
+        for future in futures:
+            # re-raises the error of a failed upload
+            future.result()
+
+    # a delete request removes at most 1000 objects
+    for start in range(0, len(stale), 1000):
+        client.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": key} for key in stale[start:start + 1000]]})
+    if stale:
+        print(f"Deleted {len(stale)} stale objects below {s3_url}")
+    return len(changed), len(keys) - len(changed), len(stale)
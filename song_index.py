@@ -0,0 +1,283 @@
+# Resolves the played songs of the log events to the song_id of songs.json when title or artist are written
+# differently, like "Hey Jude (Remastered)", "Beyoncé" or "Jay-Z feat. Kanye West". The exact `match_key` join of
+# `songplay_table_insert` misses these plays. The songs are indexed once by a normalized title and by artist and
+# duration bucket, so every play is compared with the few songs of its title instead of all songs.
+# The index is cached next to songs.json and only rebuilt when the songs changed. The cache is a pickle,
+# so only a cache written by the current user is loaded.
+import os
+import pickle
+import re
+import unicodedata
+from typing import NamedTuple, Optional
+
+from combine import file_fingerprint, file_hash
+from json_codec import get_codec
+
+# changes with the normalization or the layout of the index, so an old cache is rebuilt
+INDEX_VERSION = 1
+# seconds a played length may differ from the song duration, when the artist or the title differ
+DURATION_TOLERANCE = 2.0
+# width in seconds of the duration buckets, at least the tolerance so the neighbour buckets hold all candidates
+DURATION_BUCKET = 5
+
+# version tags and featured artists of a title, like "(Live)", "[Remix]", " - 2011 Remaster" or " feat. X"
+_TITLE_SUFFIXES = re.compile(r"\s*[(\[][^)\]]*[)\]]|\s+-\s.*$|\s+(?:feat\.?|featuring|ft\.)\s.*$", re.IGNORECASE)
+_APOSTROPHES = re.compile(r"['`’]")
+_WORDS = re.compile(r"[^\W_]+")
+# words that join the artists of a collaboration
+_ARTIST_STOPWORDS = frozenset(("the", "and", "feat", "featuring", "ft", "with", "vs"))
+
+
+class SongEntry(NamedTuple):
+    """
+    A song of the index, with what is needed to compare it with a play.
+    """
+    song_id: str
+    artist_id: str
+    duration: Optional[float]
+    # `LOWER(TRIM(title)) || '|' || LOWER(TRIM(artist_name))`, the key of the exact join
+    exact_key: str
+    artist_key: str
+    artist_tokens: frozenset
+    title_tokens: frozenset
+
+
+def fold(text):
+    """
+    :param text: a title or artist name
+    :return: the lower case words of the text, without accents, apostrophes and punctuation, `&` as `and`
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = _APOSTROPHES.sub("", text.lower().replace("&", " and "))
+    return " ".join(_WORDS.findall(text))
+
+
+def normalize_title(title):
+    """
+    :param title: the song title
+    :return: the folded title without version tags and featured artists, the whole title if nothing else is left
+    """
+    return fold(_TITLE_SUFFIXES.sub("", title)) or fold(title)
+
+
+def normalize_artist(artist):
+    """
+    :param artist: the artist name, maybe of several artists
+    :return: tuple of the folded name without a leading `the`, and the set of its name words
+    """
+    key = fold(artist)
+    if key.startswith("the "):
+        key = key[len("the "):]
+    return key, frozenset(key.split()) - _ARTIST_STOPWORDS
+
+
+def exact_key(title, artist):
+    """
+    :return: the text of `songplay_match_key` before it is hashed
+    """
+    return f"{title.strip().lower()}|{artist.strip().lower()}"
+
+
+def duration_bucket(duration):
+    """
+    :param duration: seconds
+    :return: the number of the duration bucket
+    """
+    return int(duration // DURATION_BUCKET)
+
+
+class SongIndex:
+    """
+    The songs by normalized title and by normalized artist and duration bucket.
+    """
+
+    def __init__(self):
+        self.titles = {}
+        self.artist_durations = {}
+        self.song_count = 0
+
+    def add(self, song):
+        """
+        :param song: a parsed record of songs.json
+        :return: None
+        """
+        title, artist = song.get("title"), song.get("artist_name")
+        if title is None or artist is None or not song.get("song_id"):
+            return
+        # numeric titles are loaded as text into the VARCHAR columns
+        title, artist = str(title), str(artist)
+        artist_key, artist_tokens = normalize_artist(artist)
+        title_key = normalize_title(title)
+        duration = song.get("duration")
+        entry = SongEntry(song["song_id"], song.get("artist_id"), duration, exact_key(title, artist),
+                          artist_key, artist_tokens, frozenset(title_key.split()))
+        self.titles.setdefault(title_key, []).append(entry)
+        if duration is not None:
+            self.artist_durations.setdefault((artist_key, duration_bucket(duration)), []).append(entry)
+        self.song_count += 1
+
+    def match(self, title, artist, length=None, tolerance=None):
+        """
+        Find the song of a play. The candidates are ranked by
+          * the exact key of the warehouse join, so every play it matches resolves to the same song
+          * the same normalized title and artist, within DURATION_TOLERANCE
+          * the same normalized title and a shared artist word, within DURATION_TOLERANCE
+          * the same normalized artist and at least half of the title words shared, within DURATION_TOLERANCE
+        and then by the closest duration.
+        :param title: the song of the event
+        :param artist: the artist of the event
+        :param length: the played seconds, None or NaN if unknown
+        :param tolerance: the seconds the duration may differ for the exact key, None to accept any,
+          see `songplay_duration_tolerance`
+        :return: the SongEntry, None if no song matches
+        """
+        if title is None or artist is None:
+            return None
+        title, artist = str(title), str(artist)
+        if length is not None and length != length:
+            length = None
+        key = exact_key(title, artist)
+        title_key = normalize_title(title)
+        artist_key, artist_tokens = normalize_artist(artist)
+
+        best, best_rank = None, None
+        for entry in self.titles.get(title_key, ()):
+            difference = abs(entry.duration - length) if entry.duration is not None and length is not None else None
+            if entry.exact_key == key:
+                if tolerance is not None and (difference is None or difference > tolerance):
+                    continue
+                strength = 0
+            elif difference is None or difference > DURATION_TOLERANCE:
+                continue
+            elif entry.artist_key == artist_key:
+                strength = 1
+            elif entry.artist_tokens & artist_tokens:
+                strength = 2
+            else:
+                continue
+            rank = (strength, difference if difference is not None else float("inf"), entry.song_id)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = entry, rank
+        if best is not None or length is None:
+            return best
+
+        title_tokens = frozenset(title_key.split())
+        bucket = duration_bucket(length)
+        for neighbour in (bucket - 1, bucket, bucket + 1):
+            for entry in self.artist_durations.get((artist_key, neighbour), ()):
+                difference = abs(entry.duration - length)
+                shared = len(entry.title_tokens & title_tokens)
+                if difference > DURATION_TOLERANCE or 2 * shared < len(entry.title_tokens | title_tokens):
+                    continue
+                rank = (difference, entry.song_id)
+                if best_rank is None or rank < best_rank:
+                    best, best_rank = entry, rank
+        return best
+
+    def resolve(self, plays, tolerance=None):
+        """
+        Match the plays of a batch, every distinct play is matched once.
+        :param plays: iterable of (title, artist, length) of the events
+        :param tolerance: see `match`
+        :return: list of the SongEntry or None of every play
+        """
+        matches = {}
+        resolved = []
+        for play in plays:
+            if play not in matches:
+                matches[play] = self.match(*play, tolerance=tolerance)
+            resolved.append(matches[play])
+        return resolved
+
+
+def build_song_index(songs_path, codec="auto"):
+    """
+    :param songs_path: the combined songs, like `songs.json`
+    :param codec: name of the json codec used for parsing, see `json_codec.get_codec`
+    :return: the SongIndex of all songs
+    """
+    loads = get_codec(codec).loads
+    index = SongIndex()
+    with open(songs_path, encoding="utf-8") as json_reader:
+        for line in json_reader:
+            if line.strip():
+                index.add(loads(line))
+    return index
+
+
+def index_cache_path(songs_path):
+    """
+    :param songs_path: the combined songs, like `songs.json`
+    :return: path of the cached index, like `songs.index.pickle`
+    """
+    return os.path.splitext(songs_path)[0] + ".index.pickle"
+
+
+def load_cached_index(songs_path, cache_path):
+    """
+    Size and mtime of songs.json are checked first, the content is only hashed when they differ.
+    Unpickling runs code of the file, so the cache is trusted like the code of this repository:
+    a cache that belongs to another user is ignored and rebuilt.
+    :param songs_path: the combined songs
+    :param cache_path: the cached index
+    :return: tuple of the cached SongIndex, None if it is missing, outdated or unreadable,
+      and the content hash of the songs when only their mtime changed, so the cache is written again
+    """
+    if not os.path.exists(cache_path):
+        return None, None
+    if hasattr(os, "getuid") and os.stat(cache_path).st_uid != os.getuid():
+        print(f"Ignoring the song index {cache_path}, it belongs to another user")
+        return None, None
+    try:
+        with open(cache_path, "rb") as cache_reader:
+            cache = pickle.load(cache_reader)
+    except Exception as error:
+        # the cache is rebuilt from the songs, whatever is wrong with it
+        print(f"Ignoring the unreadable song index {cache_path}: {error!r}")
+        return None, None
+    if not isinstance(cache, dict) or cache.get("version") != INDEX_VERSION:
+        return None, None
+    known = cache["songs"]
+    stat = os.stat(songs_path)
+    if stat.st_size == known["size"] and stat.st_mtime == known["mtime"]:
+        return cache["index"], None
+    content_hash = file_hash(songs_path) if stat.st_size == known["size"] else None
+    if content_hash == known["sha256"]:
+        return cache["index"], content_hash
+    return None, None
+
+
+def save_index(index, songs_path, cache_path, content_hash=None):
+    """
+    Persist the index with the fingerprint of the songs, replacing the old cache in one step.
+    :param index: the SongIndex
+    :param songs_path: the combined songs the index was built from
+    :param cache_path: the cache file
+    :param content_hash: already computed hash of the songs, calculated if missing
+    :return: None
+    """
+    cache = {"version": INDEX_VERSION, "songs": file_fingerprint(songs_path, content_hash), "index": index}
+    with open(cache_path + ".tmp", "wb") as cache_writer:
+        pickle.dump(cache, cache_writer, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_path + ".tmp", cache_path)
+
+
+def load_song_index(songs_path, cache_path=None):
+    """
+    Load the cached index of the songs, it is built and cached when the songs changed since.
+    :param songs_path: the combined songs, like `songs.json`
+    :param cache_path: the cache file, next to the songs by default
+    :return: the SongIndex
+    """
+    cache_path = cache_path or index_cache_path(songs_path)
+    index, content_hash = load_cached_index(songs_path, cache_path)
+    if index is not None:
+        if content_hash is not None:
+            save_index(index, songs_path, cache_path, content_hash)
+        print(f"Loaded the index of {index.song_count} songs from {cache_path}")
+        return index
+    index = build_song_index(songs_path)
+    save_index(index, songs_path, cache_path)
+    print(f"Built the index of {index.song_count} songs into {cache_path}")
+    return index
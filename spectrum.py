@@ -0,0 +1,84 @@
+# Registers the events of `combine.py --output partitioned` as external table of redshift spectrum.
+# Ad-hoc queries on recent days then read only the files of these days from s3, nothing is loaded into log_data.
+import argparse
+import configparser
+
+import database
+from combine import find_partitions
+from instrumentation import query_log
+from sql_queries import spectrum_events_table_create, spectrum_events_table_drop, spectrum_partition_query, \
+    spectrum_partitions_per_statement, spectrum_schema_create
+
+
+def prepare_spectrum_query(query, role_s3_read, events_location, spectrum_database):
+    """
+    Replace the placeholders of the external DDL with the actual values.
+    :param query: the statement from sql_queries.py
+    :param role_s3_read: the role that reads s3 and the data catalog
+    :param events_location: the s3 location `events_partitioned` was uploaded to
+    :param spectrum_database: the data catalog database of the external schema
+    :returns: the ready to run statement
+    """
+    return query.replace("$iam", role_s3_read) \
+        .replace("$events", events_location.rstrip("/")) \
+        .replace("$spectrum_database", spectrum_database)
+
+
+def partition_queries(partitions):
+    """
+    :param partitions: list of (year, month, day) of the partitions
+    :returns: the statements that register the partitions, in batches redshift accepts
+    """
+    return [spectrum_partition_query(partitions[start:start + spectrum_partitions_per_statement])
+            for start in range(0, len(partitions), spectrum_partitions_per_statement)]
+
+
+def parse_arguments():
+    """
+    Parse the command line options of the spectrum setup.
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Create the external table over the partitioned events "
+                                                 "and register its partitions.")
+    parser.add_argument("--partitions", default="events_partitioned",
+                        help="the local output of combine.py --output partitioned, "
+                             "every day in it is registered (default: events_partitioned)")
+    parser.add_argument("--recreate", action="store_true",
+                        help="drop and create the external table, for example after its columns changed")
+    parser.add_argument("--query-log", default="query-log.jsonl",
+                        help="json lines file every executed statement is appended to (default: query-log.jsonl)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    role_s3_read = config.get("CLUSTER", "role_s3_read")
+    events_location = config.get("AWS", "events_partitioned")
+    spectrum_database = config.get("AWS", "spectrum_database", fallback="sparkify")
+
+    queries = [spectrum_schema_create]
+    if args.recreate:
+        queries.append(spectrum_events_table_drop)
+    queries.append(spectrum_events_table_create)
+    queries += partition_queries(find_partitions(args.partitions))
+
+    query_log.start("spectrum", args.query_log)
+    conn = database.connect(database.load_settings())
+    # external DDL can not run inside a transaction block
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        for query in queries:
+            query = prepare_spectrum_query(query, role_s3_read, events_location, spectrum_database)
+            print(query)
+            database.execute(cur, conn, query)
+    finally:
+        conn.close()
+        query_log.print_summary()
+
+
+if __name__ == "__main__":
+    main()
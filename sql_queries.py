@@ -1,4 +1,5 @@
 import configparser
+import re
 
 
 # CONFIG
@@ -14,9 +15,12 @@ user_table_drop = "DROP TABLE IF EXISTS dim_users;"
 song_table_drop = "DROP TABLE IF EXISTS dim_songs;"
 artist_table_drop = "DROP TABLE IF EXISTS dim_artists;"
 time_table_drop = "DROP TABLE IF EXISTS dim_time;"
+high_water_mark_table_drop = "DROP TABLE IF EXISTS etl_high_water_mark;"
 
 # CREATE TABLES
 
+# The staging tables are distributed by what the COPY fills in: the events evenly, as userid is empty for the
+# events of logged out users, the songs on song_id like dim_songs, whose insert ranks the rows per song_id.
 staging_events_table_create= ("""
 CREATE TABLE log_data (
     artist VARCHAR(255),
@@ -25,7 +29,7 @@ CREATE TABLE log_data (
     gender CHAR(1),
     iteminsession INT,
     lastname VARCHAR(255),
-    length NUMERIC,
+    length NUMERIC(10, 5),
     level VARCHAR(255),
     location VARCHAR(255),
     method VARCHAR(255),
@@ -37,7 +41,8 @@ CREATE TABLE log_data (
     ts BIGINT,
     useragent VARCHAR(255),
     userid VARCHAR(255)
-);
+)
+DISTSTYLE EVEN;
 """)
 
 staging_songs_table_create = ("""
@@ -52,67 +57,158 @@ CREATE TABLE song_data (
     artist_id VARCHAR(255),
     artist_longitude NUMERIC(10, 5),
     artist_location VARCHAR(255)
-);
-
+)
+DISTKEY (song_id);
 """)
 
-songplay_table_create = ("""
-CREATE TABLE fact_songplays (
-    songplay_id VARCHAR(255) DISTKEY, 
-    start_time DATE, 
-    user_id VARCHAR(255), 
-    level VARCHAR(255), 
-    song_id VARCHAR(255), 
-    artist_id VARCHAR(255), 
-    session_id INT, 
-    location VARCHAR(255), 
-    user_agent VARCHAR(255)
-);
-""")
+# Physical design of the star schema, the CREATE TABLE statements below are generated from it.
+# * the fact is distributed on song_id, so the join with dim_songs (distributed the same way) stays on the slice
+# * the small dimensions are copied to every node (DISTSTYLE ALL), joins with them never redistribute
+# * the time range scans use the sort key on start_time, the dimensions are sorted by their key for merge joins
+# * numbers and timestamps are encoded with AZ64, text with ZSTD.
+#   The leading sort key column stays RAW, compressing it makes the range restricted scans read more blocks.
+# * VARCHAR lengths are in bytes, sized on the udacity data with head room
+star_schema = {
+    "fact_songplays": {
+        "columns": [
+            ("songplay_id", "BIGINT IDENTITY(0, 1)", "AZ64"),
+            ("start_time", "TIMESTAMP", "RAW"),
+            ("user_id", "VARCHAR(16)", "ZSTD"),
+            ("level", "VARCHAR(8)", "ZSTD"),
+            ("song_id", "VARCHAR(18)", "ZSTD"),
+            ("artist_id", "VARCHAR(18)", "ZSTD"),
+            ("session_id", "INT", "AZ64"),
+            ("location", "VARCHAR(256)", "ZSTD"),
+            ("user_agent", "VARCHAR(256)", "ZSTD"),
+        ],
+        "diststyle": "KEY",
+        "distkey": "song_id",
+        "sortkey": ["start_time"],
+    },
+    "dim_users": {
+        "columns": [
+            ("user_id", "VARCHAR(16)", "RAW"),
+            ("first_name", "VARCHAR(64)", "ZSTD"),
+            ("last_name", "VARCHAR(64)", "ZSTD"),
+            ("gender", "CHAR(1)", "ZSTD"),
+            ("level", "VARCHAR(8)", "ZSTD"),
+        ],
+        "diststyle": "ALL",
+        "sortkey": ["user_id"],
+    },
+    "dim_songs": {
+        "columns": [
+            ("song_id", "VARCHAR(18)", "RAW"),
+            ("title", "VARCHAR(256)", "ZSTD"),
+            ("artist_id", "VARCHAR(18)", "ZSTD"),
+            ("year", "SMALLINT", "AZ64"),
+            ("duration", "NUMERIC(10, 5)", "AZ64"),
+        ],
+        "diststyle": "KEY",
+        "distkey": "song_id",
+        "sortkey": ["song_id"],
+    },
+    "dim_artists": {
+        "columns": [
+            ("artist_id", "VARCHAR(18)", "RAW"),
+            ("name", "VARCHAR(256)", "ZSTD"),
+            ("location", "VARCHAR(256)", "ZSTD"),
+            ("latitude", "NUMERIC(10, 5)", "AZ64"),
+            ("longitude", "NUMERIC(10, 5)", "AZ64"),
+        ],
+        "diststyle": "ALL",
+        "sortkey": ["artist_id"],
+    },
+    "dim_time": {
+        "columns": [
+            ("start_time", "TIMESTAMP", "RAW"),
+            ("hour", "SMALLINT", "AZ64"),
+            ("day", "SMALLINT", "AZ64"),
+            ("week", "SMALLINT", "AZ64"),
+            ("month", "SMALLINT", "AZ64"),
+            ("year", "SMALLINT", "AZ64"),
+            ("weekday", "SMALLINT", "AZ64"),
+        ],
+        "diststyle": "ALL",
+        "sortkey": ["start_time"],
+    },
+}
 
-user_table_create = ("""
-CREATE TABLE dim_users (
-    user_id VARCHAR(255) DISTKEY,
-    first_name VARCHAR(255),
-    last_name VARCHAR(255),
-    gender CHAR(1),
-    level VARCHAR(255)
-);
-""")
 
-song_table_create = ("""
-CREATE TABLE dim_songs (
-    song_id VARCHAR(255) DISTKEY,  
-    title VARCHAR(255),
-    artist_id VARCHAR(255),
-    year INT,
-    duration NUMERIC(10, 5)
-);
-""")
+def create_table_query(table, definition):
+    """
+    Generate the CREATE TABLE statement of a table in `star_schema`.
+    :param table: the table name
+    :param definition: the columns with type and encoding, the distribution and the sort key
+    :return: the statement
+    """
+    columns = ",\n".join(f"    {name} {data_type} ENCODE {encoding}" for name, data_type, encoding in definition["columns"])
+    attributes = f"DISTSTYLE {definition['diststyle']}"
+    if definition["diststyle"] == "KEY":
+        attributes += f"\nDISTKEY ({definition['distkey']})"
+    if definition.get("sortkey"):
+        attributes += f"\nSORTKEY ({', '.join(definition['sortkey'])})"
+    return f"\nCREATE TABLE {table} (\n{columns}\n)\n{attributes};\n"
 
-artist_table_create = ("""
-CREATE TABLE dim_artists (
-    artist_id VARCHAR(255) DISTKEY,
-    name VARCHAR(255),
-    location VARCHAR(255),
-    latitude NUMERIC(10, 5),
-    longitude NUMERIC(10, 5)
+
+songplay_table_create = create_table_query("fact_songplays", star_schema["fact_songplays"])
+user_table_create = create_table_query("dim_users", star_schema["dim_users"])
+song_table_create = create_table_query("dim_songs", star_schema["dim_songs"])
+artist_table_create = create_table_query("dim_artists", star_schema["dim_artists"])
+time_table_create = create_table_query("dim_time", star_schema["dim_time"])
+
+
+
+def final_table_copy_query(table):
+    """
+    Generate the COPY of a table in `star_schema` from the gzip CSV files of `transform.py`,
+    for backfills that build the star schema outside of the cluster.
+    The placeholders '$path' and '$iam' are replaced at runtime, IDENTITY columns are generated by the table.
+    :param table: the table name
+    :return: the statement
+    """
+    columns = [name for name, data_type, _ in star_schema[table]["columns"] if "IDENTITY" not in data_type]
+    return (f"\nCOPY {table} ({', '.join(columns)}) FROM '$path' iam_role '$iam' \n"
+            f"CSV GZIP IGNOREHEADER 1 NULL AS '\\\\N' \n"
+            f"REGION 'us-west-2';\n")
+
+
+final_table_copy_queries = {table: final_table_copy_query(table) for table in star_schema}
+
+# Tracks the newest event `ts` that was merged by an incremental run of etl.py.
+high_water_mark_table_create = ("""
+CREATE TABLE etl_high_water_mark (
+    table_name VARCHAR(64),
+    last_ts BIGINT,
+    loaded_at TIMESTAMP
 );
 """)
 
-time_table_create = ("""
-CREATE TABLE dim_time (
-    start_time DATE,
-    hour INT,
-    day INT,
-    week INT,
-    month INT,
-    year INT,
-    weekday INT
-);
+# Column profiles written by `data_quality.py --profile`.
+# It is not part of create_table_queries, the history has to survive the rebuild of the tables.
+dq_history_table_create = ("""
+CREATE TABLE IF NOT EXISTS dq_history (
+    profiled_at TIMESTAMP,
+    table_name VARCHAR(64),
+    column_name VARCHAR(64),
+    sample_fraction DOUBLE PRECISION,
+    row_count BIGINT,
+    null_count BIGINT,
+    distinct_count BIGINT,
+    min_value VARCHAR(256),
+    max_value VARCHAR(256),
+    p50 DOUBLE PRECISION,
+    p95 DOUBLE PRECISION,
+    increment_from VARCHAR(64),
+    increment_to VARCHAR(64)
+)
+DISTSTYLE ALL;
 """)
 
 # STAGING TABLES
+# The json path file of the log data lists the fields in the column order of the log_data DDL above,
+# the COPYs map them by position, so the DDL is the only list of the staging columns.
+
 # Note that these statements contain three placeholders, all starting with the dollar sign,
 # that are replaced at runtime.
 staging_events_copy = ("""
@@ -129,11 +225,113 @@ FORMAT JSON 'auto'
 REGION 'us-west-2';
 """).format()
 
+# Variants of the staging COPYs for the sharded output of `combine.py --output sharded`.
+# '$events' and '$songs' point to the generated manifest files,
+# '$compression' is replaced with GZIP, ZSTD or nothing at runtime.
+# All shards listed in a manifest are loaded in parallel, one per slice.
+staging_events_manifest_copy = ("""
+COPY log_data FROM '$events' iam_role '$iam' 
+FORMAT JSON '$event_schema' 
+$compression
+MANIFEST
+REGION 'us-west-2';
+""")
+
+staging_songs_manifest_copy = ("""
+COPY song_data FROM '$songs' iam_role '$iam' 
+FORMAT JSON 'auto' 
+$compression
+MANIFEST
+REGION 'us-west-2';
+""")
+
+# Variants of the staging COPYs for the typed files of `combine.py --output parquet`.
+# '$events' and '$songs' point to the s3 prefix of the uploaded `events_parquet` / `songs_parquet` directories.
+# The columns are mapped by position, the files are written in the column order of the DDL above.
+# Columnar COPYs do not support REGION, the bucket has to be in the region of the cluster.
+staging_events_parquet_copy = ("""
+COPY log_data FROM '$events' iam_role '$iam' 
+FORMAT AS PARQUET;
+""")
+
+staging_songs_parquet_copy = ("""
+COPY song_data FROM '$songs' iam_role '$iam' 
+FORMAT AS PARQUET;
+""")
+
+# SPECTRUM
+# The events of `combine.py --output partitioned` stay in s3, in Hive style `year=/month=/day=` directories.
+# An external table over them answers ad-hoc queries on some days by reading only the files of these days,
+# without loading the history into log_data. '$events' is replaced with the s3 location of `events_partitioned`,
+# '$spectrum_database' with the data catalog database. External DDL can not run inside a transaction.
+spectrum_schema_create = ("""
+CREATE EXTERNAL SCHEMA IF NOT EXISTS spectrum 
+FROM DATA CATALOG DATABASE '$spectrum_database' 
+iam_role '$iam' 
+CREATE EXTERNAL DATABASE IF NOT EXISTS;
+""")
+
+spectrum_events_table_drop = "DROP TABLE IF EXISTS spectrum.log_events;"
+
+# The json keys are matched case-insensitive, `registration` is written as float in the udacity logs.
+spectrum_events_table_create = ("""
+CREATE EXTERNAL TABLE IF NOT EXISTS spectrum.log_events (
+    artist VARCHAR(255),
+    auth VARCHAR(255),
+    firstName VARCHAR(255),
+    gender CHAR(1),
+    iteminsession INT,
+    lastname VARCHAR(255),
+    length DECIMAL(10, 5),
+    level VARCHAR(255),
+    location VARCHAR(255),
+    method VARCHAR(255),
+    page VARCHAR(255),
+    registration DOUBLE PRECISION,
+    sessionId INT,
+    song VARCHAR(255),
+    status INT,
+    ts BIGINT,
+    useragent VARCHAR(255),
+    userid VARCHAR(255)
+)
+PARTITIONED BY (year SMALLINT, month SMALLINT, day SMALLINT)
+ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'
+STORED AS TEXTFILE
+LOCATION '$events/';
+""")
+
+# redshift adds at most 100 partitions with one statement
+spectrum_partitions_per_statement = 100
+
+
+def spectrum_partition_query(partitions):
+    """
+    Register the partitions of days with the external table, partitions that are already known are skipped.
+    :param partitions: list of (year, month, day) strings, as in the directory names, like ("2018", "11", "01")
+    :return: the statement, with the '$events' placeholder of the table location
+    """
+    clauses = "\n".join(
+        f"PARTITION (year={int(year)}, month={int(month)}, day={int(day)}) "
+        f"LOCATION '$events/year={year}/month={month}/day={day}/'"
+        for year, month, day in partitions
+    )
+    return f"\nALTER TABLE spectrum.log_events ADD IF NOT EXISTS \n{clauses};\n"
+
+
 # FINAL TABLES
 
+# Accept a song only when its duration differs at most this many seconds from the played length, None to disable.
+# The key of title and artist alone also matches different recordings of a song.
+songplay_duration_tolerance = None
+
+# The normalized title + artist of a song, hashed to a BIGINT.
+# It is computed while the songplays are built, so the join is a hash join on one narrow column,
+# instead of comparing two wide VARCHAR columns, and only the plays are hashed, not the other events.
+songplay_match_key = "FNV_HASH(LOWER(TRIM({title})) || '|' || LOWER(TRIM({artist})))"
+
 songplay_table_insert = ("""
 INSERT INTO fact_songplays (
-    songplay_id,
     start_time,
     user_id,
     level,
@@ -143,62 +341,94 @@ INSERT INTO fact_songplays (
     location,
     user_agent
 )
-SELECT (TO_CHAR(
-        DATEADD(SECOND, log_data.ts / 1000, '1970-01-01'::DATE), 'YYYY-MM-DD HH24:MI:SS'
-    ) || '-' || log_data.userid || '-' || song_data.song_id)::text AS songplay_id,
-  DATEADD(SECOND, log_data.ts / 1000, '1970-01-01'::DATE) AS start_time,
-  log_data.userid AS user_id,
-  log_data.level AS level,
-  song_data.song_id AS song_id,
-  song_data.artist_id AS artist_id,
-  log_data.sessionid AS session_id,
-  log_data.location AS "location",
-  log_data.useragent AS user_agent
-FROM log_data, song_data
-WHERE (song_data.title = log_data.song AND song_data.artist_name = log_data.artist);
-
+SELECT 
+  DATEADD(SECOND, plays.ts / 1000, '1970-01-01'::DATE) AS start_time,
+  plays.userid AS user_id,
+  plays.level AS level,
+  songs.song_id AS song_id,
+  songs.artist_id AS artist_id,
+  plays.sessionid AS session_id,
+  plays.location AS "location",
+  plays.useragent AS user_agent
+FROM (
+  SELECT 
+    log_data.ts, log_data.userid, log_data.level, log_data.sessionid, log_data.location, log_data.useragent,
+    log_data.length,
+    """ + songplay_match_key.format(title="log_data.song", artist="log_data.artist") + """ AS match_key 
+  FROM log_data 
+  WHERE log_data.page = 'NextSong'
+) AS plays 
+JOIN (
+  SELECT 
+    song_data.song_id, song_data.artist_id, song_data.duration,
+    """ + songplay_match_key.format(title="song_data.title", artist="song_data.artist_name") + """ AS match_key 
+  FROM song_data
+) AS songs ON songs.match_key = plays.match_key""" + (
+    "" if songplay_duration_tolerance is None
+    else f"\n  AND ABS(songs.duration - plays.length) <= {songplay_duration_tolerance}"
+) + """;
 """)
 
+# The dimensions hold one row per key.
+# Users keep the attributes of their latest event, so a user that upgraded shows the current level.
 user_table_insert = ("""
 INSERT INTO dim_users (user_id, first_name, last_name, gender, level) 
-SELECT 
-  log_data.userid AS user_id,
-  log_data.firstname AS first_name,
-  log_data.lastname AS last_name,
-  log_data.gender AS gender,
-  log_data.level AS level 
-FROM log_data 
-WHERE log_data.userid is not null 
-  AND log_data.page = 'NextSong' 
-  AND log_data.status = 200;
-
+SELECT user_id, first_name, last_name, gender, level 
+FROM (
+  SELECT 
+    log_data.userid AS user_id,
+    log_data.firstname AS first_name,
+    log_data.lastname AS last_name,
+    log_data.gender AS gender,
+    log_data.level AS level,
+    ROW_NUMBER() OVER (PARTITION BY log_data.userid ORDER BY log_data.ts DESC) AS user_rank 
+  FROM log_data 
+  WHERE log_data.userid is not null 
+    AND log_data.page = 'NextSong' 
+    AND log_data.status = 200
+) AS users 
+WHERE users.user_rank = 1;
 """)
 
 song_table_insert = ("""
 INSERT INTO dim_songs (song_id, title, artist_id, "year", duration)  
-SELECT 
-  song_data.song_id AS song_id,
-  song_data.title AS title,
-  song_data.artist_id AS artist_id,
-  song_data."year" AS "year",
-  song_data.duration AS duration 
-FROM song_data;
+SELECT song_id, title, artist_id, "year", duration 
+FROM (
+  SELECT 
+    song_data.song_id AS song_id,
+    song_data.title AS title,
+    song_data.artist_id AS artist_id,
+    song_data."year" AS "year",
+    song_data.duration AS duration,
+    ROW_NUMBER() OVER (PARTITION BY song_data.song_id ORDER BY song_data."year" DESC) AS song_rank 
+  FROM song_data
+) AS songs 
+WHERE songs.song_rank = 1;
 """)
 
+# An artist appears once per song, the row with a known location is preferred.
 artist_table_insert = ("""
 INSERT INTO dim_artists (artist_id, name, location, latitude, longitude) 
-SELECT 
-  song_data.artist_id AS artist_id,
-  song_data.artist_name AS name, 
-  song_data.artist_location AS location,
-  song_data.artist_latitude AS latitude,
-  song_data.artist_longitude AS longitude 
-FROM song_data;
+SELECT artist_id, name, location, latitude, longitude 
+FROM (
+  SELECT 
+    song_data.artist_id AS artist_id,
+    song_data.artist_name AS name, 
+    song_data.artist_location AS location,
+    song_data.artist_latitude AS latitude,
+    song_data.artist_longitude AS longitude,
+    ROW_NUMBER() OVER (
+      PARTITION BY song_data.artist_id 
+      ORDER BY CASE WHEN song_data.artist_latitude IS NULL THEN 1 ELSE 0 END, song_data.artist_location
+    ) AS artist_rank 
+  FROM song_data
+) AS artists 
+WHERE artists.artist_rank = 1;
 """)
 
 time_table_insert = ("""
 INSERT INTO dim_time (start_time, hour ,day, week, month, year, weekday) 
-SELECT 
+SELECT DISTINCT 
   DATEADD(SECOND, log_data.ts / 1000, '1970-01-01'::DATE) AS start_time, 
   EXTRACT(HOUR FROM DATEADD(SECOND, log_data.ts / 1000, '1970-01-01'::DATE)) AS hour,
   EXTRACT(DAY FROM DATEADD(SECOND, log_data.ts / 1000, '1970-01-01'::DATE)) AS day,
@@ -209,9 +439,153 @@ SELECT
 FROM log_data;
 """)
 
+# INCREMENTAL LOAD
+# An incremental run of etl.py stages only new events and merges them into the existing tables,
+# instead of dropping and rebuilding them.
+
+# The staging tables only hold the files of the current run, otherwise an incremental run would merge
+# the events and songs of every earlier run again, and each play would join every staged copy of its song.
+# Runs in the same transaction before the COPY, TRUNCATE would commit the open transaction in redshift.
+staging_events_clear = "DELETE FROM log_data;"
+staging_songs_clear = "DELETE FROM song_data;"
+
+# Removes the events from staging that were already merged by an earlier run.
+# Runs in the same transaction as the COPY, so the inserts only ever see the new events.
+# Events that arrive late, with a ts at or below the high water mark, are removed as well,
+# the query log records their number as `pruned` of the COPY.
+staging_events_prune = ("""
+DELETE FROM log_data 
+WHERE ts <= (SELECT COALESCE(MAX(last_ts), 0) FROM etl_high_water_mark WHERE table_name = 'log_data');
+""")
+
+high_water_mark_insert = ("""
+INSERT INTO etl_high_water_mark (table_name, last_ts, loaded_at) 
+SELECT 'log_data', MAX(ts), GETDATE() 
+FROM log_data 
+HAVING MAX(ts) IS NOT NULL;
+""")
+
+
+def merge_query(insert_query, table, keys):
+    """
+    Turn a full insert into a staged delete + insert merge, keyed on the natural key of the table.
+    The rows of the insert are written to a temporary table first,
+    the existing rows with the same key are replaced by them, all in one transaction.
+    Only the columns of the insert are copied, so IDENTITY columns are generated by the target table.
+    :param insert_query: the insert into `table`, as used for the full load
+    :param table: the target table
+    :param keys: the natural key column of the table, or a list of columns
+    :return: the merge statements
+    """
+    stage = f"{table}_stage"
+    insert_into = re.search(rf"INSERT INTO {table} \(([^)]*)\)", insert_query)
+    columns = " ".join(insert_into.group(1).split())
+    select = insert_query[insert_into.end():].strip()
+    keys = [keys] if isinstance(keys, str) else keys
+    key_condition = " AND ".join(f"{table}.{key} = {stage}.{key}" for key in keys)
+    return f"""
+CREATE TEMP TABLE {stage} AS 
+{select}
+DELETE FROM {table} USING {stage} WHERE {key_condition};
+INSERT INTO {table} ({columns}) SELECT {columns} FROM {stage};
+DROP TABLE {stage};
+"""
+
+
+# the surrogate songplay_id is generated, a songplay is identified by when, who and what was played
+songplay_natural_key = ["start_time", "user_id", "session_id", "song_id"]
+
+# the natural key of every table of the star schema, unique after each load, see data_quality.py
+table_keys = {
+    "fact_songplays": songplay_natural_key,
+    "dim_users": "user_id",
+    "dim_songs": "song_id",
+    "dim_artists": "artist_id",
+    "dim_time": "start_time",
+}
+
+songplay_table_merge = merge_query(songplay_table_insert, "fact_songplays", songplay_natural_key)
+user_table_merge = merge_query(user_table_insert, "dim_users", table_keys["dim_users"])
+song_table_merge = merge_query(song_table_insert, "dim_songs", table_keys["dim_songs"])
+artist_table_merge = merge_query(artist_table_insert, "dim_artists", table_keys["dim_artists"])
+time_table_merge = merge_query(time_table_insert, "dim_time", table_keys["dim_time"])
+
+# REPORTING
+# Pre-aggregated answers to the business questions, refreshed by etl.py after the load.
+# The dashboards read these instead of aggregating the whole fact table on every request, see reports.py.
+
+top_songs_view_drop = "DROP MATERIALIZED VIEW IF EXISTS mv_top_songs;"
+plays_by_time_view_drop = "DROP MATERIALIZED VIEW IF EXISTS mv_plays_by_time;"
+plays_by_level_view_drop = "DROP MATERIALIZED VIEW IF EXISTS mv_plays_by_level;"
+
+top_songs_view_create = ("""
+CREATE MATERIALIZED VIEW mv_top_songs 
+AUTO REFRESH NO 
+AS 
+SELECT 
+  fact_songplays.song_id AS song_id,
+  dim_songs.title AS title,
+  dim_artists.name AS artist,
+  COUNT(*) AS plays 
+FROM fact_songplays 
+JOIN dim_songs ON fact_songplays.song_id = dim_songs.song_id 
+JOIN dim_artists ON fact_songplays.artist_id = dim_artists.artist_id 
+GROUP BY fact_songplays.song_id, dim_songs.title, dim_artists.name;
+""")
+
+plays_by_time_view_create = ("""
+CREATE MATERIALIZED VIEW mv_plays_by_time 
+AUTO REFRESH NO 
+AS 
+SELECT 
+  dim_time.weekday AS weekday,
+  dim_time.hour AS hour,
+  COUNT(*) AS plays 
+FROM fact_songplays 
+JOIN dim_time ON fact_songplays.start_time = dim_time.start_time 
+GROUP BY dim_time.weekday, dim_time.hour;
+""")
+
+plays_by_level_view_create = ("""
+CREATE MATERIALIZED VIEW mv_plays_by_level 
+AUTO REFRESH NO 
+AS 
+SELECT 
+  fact_songplays.level AS level,
+  COUNT(*) AS plays,
+  COUNT(DISTINCT fact_songplays.user_id) AS users 
+FROM fact_songplays 
+GROUP BY fact_songplays.level;
+""")
+
+top_songs_view_refresh = "REFRESH MATERIALIZED VIEW mv_top_songs;"
+plays_by_time_view_refresh = "REFRESH MATERIALIZED VIEW mv_plays_by_time;"
+plays_by_level_view_refresh = "REFRESH MATERIALIZED VIEW mv_plays_by_level;"
+
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, high_water_mark_table_create, top_songs_view_create, plays_by_time_view_create, plays_by_level_view_create]
+# the views depend on the tables, so they are dropped first
+drop_table_queries = [top_songs_view_drop, plays_by_time_view_drop, plays_by_level_view_drop, staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, high_water_mark_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+copy_manifest_table_queries = [staging_events_manifest_copy, staging_songs_manifest_copy]
+copy_parquet_table_queries = [staging_events_parquet_copy, staging_songs_parquet_copy]
+# run before the COPY of the staging table, in the same transaction
+staging_clear_queries = {"log_data": staging_events_clear, "song_data": staging_songs_clear}
+# the full load seeds the high water mark, so the first incremental run only merges newer events
+insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert, high_water_mark_insert]
+# the high water mark is only moved after every merge succeeded
+merge_table_queries = [songplay_table_merge, user_table_merge, song_table_merge, artist_table_merge, time_table_merge, high_water_mark_insert]
+refresh_view_queries = [top_songs_view_refresh, plays_by_time_view_refresh, plays_by_level_view_refresh]
+# tables read by the inserts, etl.py runs an insert as soon as all of its sources are loaded
+insert_table_sources = {
+    "fact_songplays": ["log_data", "song_data"],
+    "dim_users": ["log_data"],
+    "dim_songs": ["song_data"],
+    "dim_artists": ["song_data"],
+    "dim_time": ["log_data"],
+    "etl_high_water_mark": ["log_data", "fact_songplays", "dim_users", "dim_songs", "dim_artists", "dim_time"],
+    "mv_top_songs": ["fact_songplays", "dim_songs", "dim_artists"],
+    "mv_plays_by_time": ["fact_songplays", "dim_time"],
+    "mv_plays_by_level": ["fact_songplays"],
+}
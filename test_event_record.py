@@ -0,0 +1,34 @@
+import pickle
+
+from combine import EVENT_COLUMNS, new_stats, validate_record
+from event_record import EventRecord
+
+EVENT = {"artist": "Des'ree", "itemInSession": 1, "length": 246.30812, "page": "NextSong", "sessionId": 139,
+         "song": "You Gotta Be", "status": 200, "ts": 1541106106796, "userId": "8"}
+
+
+def test_numeric_keys_are_typed_when_built():
+    record = EventRecord(dict(EVENT, sessionId="139", length=246, ts="late"))
+
+    assert (record.sessionId, record.length, record.ts, record.status) == (139, 246.0, None, 200)
+    assert record.to_dict() == dict(EVENT, sessionId="139", length=246, ts="late")
+
+
+def test_failed_conversions_are_flagged_by_the_validation():
+    stats = new_stats(EVENT_COLUMNS)
+
+    problems = validate_record(EventRecord(dict(EVENT, ts="late", status="")), EVENT_COLUMNS, ["ts"], stats)
+
+    assert problems == ["ts: not int64"]
+    assert stats["fields"]["ts"]["invalid"] == 1
+    assert stats["fields"]["status"]["null"] == 1
+
+
+def test_pickled_record_keeps_the_json_values():
+    record = EventRecord(dict(EVENT, sessionId="139", extra_key=True))
+
+    restored = pickle.loads(pickle.dumps(record))
+
+    assert restored == record
+    assert restored.sessionId == 139
+    assert restored.get("sessionId") == "139"
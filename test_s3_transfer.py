@@ -0,0 +1,86 @@
+import json
+import sys
+
+import pytest
+from moto import mock_aws
+
+import combine
+from s3_transfer import S3Source, TransferSettings, create_client, list_objects
+
+SETTINGS = TransferSettings(concurrency=4)
+DAYS = ["2018-11-03", "2018-11-01", "2018-11-02"]
+
+
+def event(day, index):
+    return {"artist": "Des'ree", "auth": "Logged In", "itemInSession": index, "length": 246.30812, "level": "free",
+            "page": "NextSong", "sessionId": 139, "song": "You Gotta Be", "status": 200,
+            "ts": 1541030400000 + DAYS.index(day) * 1000 + index, "userId": "8"}
+
+
+def song(index):
+    return {"song_id": f"SO{index:016d}", "num_songs": 1, "title": f"Song {index}", "artist_id": f"AR{index}",
+            "artist_name": "Artist", "duration": 200.0, "year": 0}
+
+
+@pytest.fixture
+def s3(monkeypatch, tmp_path):
+    """
+    The udacity bucket with a few log and song files, and an empty bucket to upload to, in a mocked s3.
+    The objects are put out of their key order.
+    """
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SECURITY_TOKEN", "AWS_SESSION_TOKEN"):
+        monkeypatch.setenv(name, "testing")
+    monkeypatch.chdir(tmp_path)
+    with mock_aws():
+        client = create_client(SETTINGS)
+        for bucket in ("udacity-dend", "sparkify"):
+            client.create_bucket(Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": SETTINGS.region})
+        for day in DAYS:
+            client.put_object(Bucket="udacity-dend", Key=f"log_data/2018/11/{day}-events.json",
+                              Body="\n".join(json.dumps(event(day, index)) for index in range(3)) + "\n")
+        for index in (2, 0, 1):
+            client.put_object(Bucket="udacity-dend", Key=f"song_data/A/B/C/TRABC{index:013d}.json",
+                              Body=json.dumps(song(index)))
+        client.put_object(Bucket="udacity-dend", Key="log_data/2018/11/README.txt", Body="not json")
+        yield client
+
+
+def run_combine(monkeypatch, *arguments):
+    monkeypatch.setattr(sys, "argv", ["combine.py", "--source", "s3://udacity-dend", "--s3-prefix", "s3://sparkify/out",
+                                      "--upload", "--transfer-concurrency", "4", *arguments])
+    combine.main()
+
+
+def test_list_files_in_key_order(s3):
+    files = S3Source("s3://udacity-dend/log_data", s3, SETTINGS).list_files()
+
+    assert [file.key for file in files] == [f"log_data/2018/11/{day}-events.json" for day in sorted(DAYS)]
+
+
+def test_combine_from_s3_keeps_the_key_order_and_skips_unchanged_uploads(s3, monkeypatch, capsys):
+    run_combine(monkeypatch)
+
+    with open("events.json", encoding="utf-8") as events_reader:
+        days = [json.loads(line)["event_day"] for line in events_reader]
+    assert days == ["01"] * 3 + ["02"] * 3 + ["03"] * 3
+    assert set(list_objects(s3, "sparkify", "out/")) == {"out/events.json", "out/songs.json"}
+    assert "Uploading 2 files to s3://sparkify/out, 0 are unchanged" in capsys.readouterr().out
+
+    run_combine(monkeypatch)
+
+    assert "Uploading 0 files to s3://sparkify/out, 2 are unchanged" in capsys.readouterr().out
+
+
+def test_upload_of_shards_deletes_stale_shards(s3, monkeypatch):
+    s3.put_object(Bucket="sparkify", Key="out/events/events-0099.json.gz", Body=b"stale")
+    s3.put_object(Bucket="sparkify", Key="out/events_parquet/events-0000.parquet", Body=b"other output")
+
+    run_combine(monkeypatch, "--output", "sharded", "--slices", "2")
+
+    keys = set(list_objects(s3, "sparkify", "out/"))
+    assert keys == {"out/events/events-0000.json.gz", "out/events/events-0001.json.gz", "out/events.manifest",
+                    "out/songs/songs-0000.json.gz", "out/songs/songs-0001.json.gz", "out/songs.manifest",
+                    "out/events_parquet/events-0000.parquet"}
+    manifest = json.loads(s3.get_object(Bucket="sparkify", Key="out/events.manifest")["Body"].read())
+    assert [entry["url"] for entry in manifest["entries"]] == ["s3://sparkify/out/events/events-0000.json.gz",
+                                                              "s3://sparkify/out/events/events-0001.json.gz"]
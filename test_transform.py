@@ -0,0 +1,51 @@
+import json
+
+import pandas
+
+from combine import EVENT_COLUMNS, SONG_COLUMNS
+from transform import match_key, read_batches, transform_songplays
+
+
+def read_records(tmp_path, name, records, columns):
+    """
+    :param tmp_path: the directory of the json lines file
+    :param name: the file name
+    :param records: the json records
+    :param columns: EVENT_COLUMNS or SONG_COLUMNS
+    :return: the typed DataFrame, like `transform` reads it
+    """
+    path = tmp_path / name
+    path.write_text("".join(json.dumps(record) + "\n" for record in records), encoding="utf-8")
+    return pandas.concat(list(read_batches(pandas, str(path), columns)), ignore_index=True)
+
+
+def play(song, artist, ts):
+    return {"artist": artist, "song": song, "length": 200.0, "page": "NextSong", "ts": ts, "userId": "7",
+            "level": "free", "sessionId": 1, "location": "Tampa, FL", "userAgent": "Mozilla"}
+
+
+def test_match_key_of_numeric_title_and_artist_is_text(tmp_path):
+    songs = read_records(tmp_path, "songs.json", [{"song_id": "SO1", "title": 66, "artist_name": 883},
+                                                  {"song_id": "SO2", "title": None, "artist_name": 4}], SONG_COLUMNS)
+
+    keys = match_key(songs["title"], songs["artist_name"])
+
+    assert keys[0] == "66|883"
+    assert pandas.isna(keys[1])
+
+
+def test_songplays_do_not_join_numeric_or_null_keys_to_each_other(tmp_path):
+    songs = read_records(tmp_path, "songs.json", [
+        {"song_id": "SO1", "artist_id": "AR1", "title": 66, "artist_name": 883, "duration": 200.0},
+        {"song_id": "SO2", "artist_id": "AR2", "title": 4, "artist_name": 883, "duration": 200.0},
+        {"song_id": "SO3", "artist_id": "AR3", "title": None, "artist_name": "Simple Minds", "duration": 200.0},
+    ], SONG_COLUMNS)
+    songs["match_key"] = match_key(songs["title"], songs["artist_name"])
+    events = read_records(tmp_path, "events.json", [
+        play(66, 883, 1541105830796), play("66", " 883 ", 1541105830797),
+        play("4", "Simple Minds", 1541105830798), play(None, "Simple Minds", 1541105830799),
+    ], EVENT_COLUMNS)
+
+    songplays = transform_songplays(pandas, events, songs)
+
+    assert list(songplays["song_id"]) == ["SO1", "SO1"]
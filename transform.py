@@ -0,0 +1,372 @@
+# Builds the star schema of sql_queries.py from the combined files on a single machine, for backfills.
+# The derivations of the inserts run as vectorized column operations with pandas over batches of events,
+# the tables are written as gzip CSV files that `final_table_copy_queries` load without any transformation.
+import argparse
+import configparser
+import gzip
+import itertools
+import os
+import time
+
+from combine import EVENT_COLUMNS, SONG_COLUMNS
+from json_codec import get_codec
+from song_index import load_song_index
+from sql_queries import final_table_copy_queries, songplay_duration_tolerance, star_schema
+
+# number of events read and transformed at once
+BATCH_SIZE = 100000
+# the marker of null values in the CSV files, see `final_table_copy_query`
+NULL_MARKER = "\\N"
+
+
+def import_pandas():
+    """
+    pandas is only needed for the local transform, so it is imported on demand.
+    :return: the pandas module
+    """
+    try:
+        import pandas
+    except ImportError:
+        raise RuntimeError("the local transform requires the 'pandas' package: pip3 install pandas")
+    return pandas
+
+
+def type_columns(pandas, frame, columns):
+    """
+    Rename and type the json fields like the staging tables, see `convert_value` of combine.py.
+    Empty strings in numeric columns become null.
+    :param pandas: the pandas module
+    :param frame: the json records of a batch
+    :param columns: EVENT_COLUMNS or SONG_COLUMNS
+    :return: the DataFrame with the columns of the staging table
+    """
+    typed = {}
+    for column_name, json_key, column_type in columns:
+        if json_key in frame:
+            values = frame[json_key]
+        else:
+            values = pandas.Series(None, index=frame.index, dtype=object)
+        if column_type == "string":
+            typed[column_name] = values.astype(object).where(values.notna(), None)
+        elif column_type.startswith("decimal"):
+            typed[column_name] = pandas.to_numeric(values, errors="coerce").astype("float64")
+        else:
+            # fractions are truncated, like by `int` in combine.py
+            numbers = pandas.to_numeric(values, errors="coerce").astype("float64")
+            typed[column_name] = numbers.fillna(0).astype("int64").astype("Int64").mask(numbers.isna())
+    return pandas.DataFrame(typed, index=frame.index)
+
+
+def read_batches(pandas, path, columns, batch_size=BATCH_SIZE, codec="auto"):
+    """
+    Stream a combined json lines file in typed batches.
+    The lines are parsed by the json codec, which is about twice as fast as `pandas.read_json` with orjson.
+    :param pandas: the pandas module
+    :param path: the combined file, like `events.json`
+    :param columns: EVENT_COLUMNS or SONG_COLUMNS
+    :param batch_size: number of records per batch
+    :param codec: name of the json codec used for parsing, see `json_codec.get_codec`
+    :return: generator of DataFrames
+    """
+    loads = get_codec(codec).loads
+    with open(path, encoding="utf-8") as json_reader:
+        while True:
+            lines = list(itertools.islice(json_reader, batch_size))
+            if not lines:
+                return
+            # object columns keep the json values, a text column of numbers and nulls would become float otherwise
+            records = pandas.DataFrame([loads(line) for line in lines if line.strip()], dtype=object)
+            yield type_columns(pandas, records, columns)
+
+
+def match_key(titles, artists):
+    """
+    The normalized title + artist of `songplay_match_key`, as text instead of its hash.
+    :param titles: the song titles
+    :param artists: the artist names
+    :return: Series of the keys, null if one of the parts is null
+    """
+    # numeric titles and artists of the json are text in the VARCHAR columns, so they are compared as text
+    keys = titles.astype(str).str.strip().str.lower() + "|" + artists.astype(str).str.strip().str.lower()
+    return keys.where(titles.notna() & artists.notna())
+
+
+def start_times(pandas, ts):
+    """
+    :param pandas: the pandas module
+    :param ts: the epoch milliseconds of the events
+    :return: the start times, truncated to whole seconds like `DATEADD(SECOND, ts / 1000, ...)`
+    """
+    return pandas.to_datetime(ts // 1000, unit="s")
+
+
+def resolve_songs(pandas, plays, song_index):
+    """
+    Look up the songs of the plays in the SongIndex, instead of the exact join on `match_key`.
+    :param pandas: the pandas module
+    :param plays: the NextSong events
+    :param song_index: the SongIndex of the songs
+    :return: the plays that resolved to a song, with its song_id and artist_id
+    """
+    entries = song_index.resolve(zip(plays["song"], plays["artist"], plays["length"]), songplay_duration_tolerance)
+    plays = plays.assign(song_id=pandas.Series([entry.song_id if entry else None for entry in entries],
+                                               index=plays.index, dtype=object),
+                         artist_id=pandas.Series([entry.artist_id if entry else None for entry in entries],
+                                                 index=plays.index, dtype=object))
+    return plays[plays["song_id"].notna()]
+
+
+def transform_songplays(pandas, events, songs, song_index=None):
+    """
+    The songplays of a batch of events, like `songplay_table_insert`.
+    :param pandas: the pandas module
+    :param events: the typed events
+    :param songs: the typed songs with their `match_key`
+    :param song_index: the SongIndex that also matches titles and artists written differently,
+      None for the exact join of the warehouse
+    :return: DataFrame with the columns of fact_songplays, without the generated songplay_id
+    """
+    plays = events[events["page"] == "NextSong"]
+    if song_index is not None:
+        plays = resolve_songs(pandas, plays, song_index)
+    else:
+        plays = plays.assign(match_key=match_key(plays["song"], plays["artist"]))
+        # pandas joins null keys to each other, the warehouse join does not
+        plays = plays[plays["match_key"].notna()].merge(
+            songs.loc[songs["match_key"].notna(), ["match_key", "song_id", "artist_id", "duration"]], on="match_key")
+        if songplay_duration_tolerance is not None:
+            plays = plays[(plays["duration"] - plays["length"]).abs() <= songplay_duration_tolerance]
+    return pandas.DataFrame({
+        "start_time": start_times(pandas, plays["ts"]),
+        "user_id": plays["userid"],
+        "level": plays["level"],
+        "song_id": plays["song_id"],
+        "artist_id": plays["artist_id"],
+        "session_id": plays["sessionid"],
+        "location": plays["location"],
+        "user_agent": plays["useragent"],
+    })
+
+
+def latest_users(pandas, events, users=None):
+    """
+    Reduce a batch of events to the latest event per user, like `user_table_insert`.
+    :param pandas: the pandas module
+    :param events: the typed events
+    :param users: the latest events of the former batches, optional
+    :return: the latest event per user of all batches so far
+    """
+    served = events["status"].eq(200).fillna(False).astype(bool)
+    events = events[events["userid"].notna() & (events["page"] == "NextSong") & served]
+    if users is not None:
+        events = pandas.concat([users, events])
+    return events.sort_values("ts", kind="mergesort").drop_duplicates("userid", keep="last")
+
+
+def transform_users(pandas, users):
+    """
+    :param pandas: the pandas module
+    :param users: the latest event per user
+    :return: DataFrame with the columns of dim_users
+    """
+    return pandas.DataFrame({
+        "user_id": users["userid"],
+        "first_name": users["firstname"],
+        "last_name": users["lastname"],
+        "gender": users["gender"],
+        "level": users["level"],
+    }).sort_values("user_id")
+
+
+def transform_songs(pandas, songs):
+    """
+    One row per song, the latest year first, like `song_table_insert`.
+    Nulls sort first in descending order, like in redshift.
+    :param pandas: the pandas module
+    :param songs: the typed songs
+    :return: DataFrame with the columns of dim_songs
+    """
+    songs = songs.sort_values("year", ascending=False, na_position="first", kind="mergesort")
+    songs = songs.drop_duplicates("song_id")
+    return pandas.DataFrame({
+        "song_id": songs["song_id"],
+        "title": songs["title"],
+        "artist_id": songs["artist_id"],
+        "year": songs["year"],
+        "duration": songs["duration"],
+    }).sort_values("song_id")
+
+
+def transform_artists(pandas, songs):
+    """
+    One row per artist, preferring a row with a known location, like `artist_table_insert`.
+    :param pandas: the pandas module
+    :param songs: the typed songs
+    :return: DataFrame with the columns of dim_artists
+    """
+    songs = songs.assign(unknown_latitude=songs["artist_latitude"].isna().astype("int8"))
+    songs = songs.sort_values(["unknown_latitude", "artist_location"], na_position="last", kind="mergesort")
+    artists = songs.drop_duplicates("artist_id")
+    return pandas.DataFrame({
+        "artist_id": artists["artist_id"],
+        "name": artists["artist_name"],
+        "location": artists["artist_location"],
+        "latitude": artists["artist_latitude"],
+        "longitude": artists["artist_longitude"],
+    }).sort_values("artist_id")
+
+
+def transform_time(pandas, times):
+    """
+    The breakdown of the distinct start times, like `time_table_insert`.
+    Week is the ISO week and weekday counts from sunday as 0, like EXTRACT in redshift.
+    :param pandas: the pandas module
+    :param times: the start times of all events
+    :return: DataFrame with the columns of dim_time
+    """
+    times = pandas.Series(times.dropna().unique()).sort_values(ignore_index=True)
+    return pandas.DataFrame({
+        "start_time": times,
+        "hour": times.dt.hour,
+        "day": times.dt.day,
+        "week": times.dt.isocalendar().week.astype("int64"),
+        "month": times.dt.month,
+        "year": times.dt.year,
+        "weekday": (times.dt.dayofweek + 1) % 7,
+    })
+
+
+def table_path(target_dir, table):
+    """
+    :param target_dir: the output directory
+    :param table: a table of the star schema
+    :return: the CSV file of the table
+    """
+    return os.path.join(target_dir, f"{table}.csv.gz")
+
+
+def open_table(target_dir, table):
+    """
+    :param target_dir: the output directory
+    :param table: a table of the star schema
+    :return: writable text file object of the gzip CSV file of the table
+    """
+    # level 6 like the shards of combine.py
+    return gzip.open(table_path(target_dir, table), "wt", compresslevel=6, encoding="utf-8", newline="")
+
+
+def write_table(frame, table_writer, header=True):
+    """
+    Write the rows in the column order of `final_table_copy_query`.
+    :param frame: the rows of the table
+    :param table_writer: the file of `open_table`
+    :param header: write the column names first, only for the first batch of a table
+    :return: the number of written rows
+    """
+    frame.to_csv(table_writer, index=False, header=header, na_rep=NULL_MARKER, date_format="%Y-%m-%d %H:%M:%S")
+    return len(frame)
+
+
+def write_complete_table(frame, target_dir, table):
+    """
+    :param frame: all rows of the table
+    :param target_dir: the output directory
+    :param table: a table of the star schema
+    :return: the number of written rows
+    """
+    with open_table(target_dir, table) as table_writer:
+        return write_table(frame, table_writer)
+
+
+def transform(events_path, songs_path, target_dir, batch_size=BATCH_SIZE, song_index=None):
+    """
+    Build the tables of the star schema from the combined files.
+    The songs are read at once, they are the lookup of the songplays.
+    The events are transformed in batches, only the latest event per user and the distinct start times are kept.
+    :param events_path: the combined events, like `events.json`
+    :param songs_path: the combined songs, like `songs.json`
+    :param target_dir: the directory the CSV files are written to
+    :param batch_size: number of events per batch
+    :param song_index: the SongIndex the songplays are resolved with, None for the exact join of the warehouse
+    :return: dict of table to the number of rows
+    """
+    pandas = import_pandas()
+    os.makedirs(target_dir, exist_ok=True)
+    counts = {}
+
+    songs = pandas.concat(list(read_batches(pandas, songs_path, SONG_COLUMNS, batch_size)), ignore_index=True)
+    songs["match_key"] = match_key(songs["title"], songs["artist_name"])
+    counts["dim_songs"] = write_complete_table(transform_songs(pandas, songs), target_dir, "dim_songs")
+    counts["dim_artists"] = write_complete_table(transform_artists(pandas, songs), target_dir, "dim_artists")
+
+    counts["fact_songplays"] = 0
+    users = latest_users(pandas, type_columns(pandas, pandas.DataFrame(), EVENT_COLUMNS))
+    times = []
+    with open_table(target_dir, "fact_songplays") as songplay_writer:
+        for index, events in enumerate(read_batches(pandas, events_path, EVENT_COLUMNS, batch_size)):
+            songplays = transform_songplays(pandas, events, songs, song_index)
+            counts["fact_songplays"] += write_table(songplays, songplay_writer, header=index == 0)
+            users = latest_users(pandas, events, users)
+            times.append(pandas.Series(start_times(pandas, events["ts"]).unique()))
+
+    counts["dim_users"] = write_complete_table(transform_users(pandas, users), target_dir, "dim_users")
+    all_times = pandas.concat(times) if times else pandas.Series([], dtype="datetime64[s]")
+    counts["dim_time"] = write_complete_table(transform_time(pandas, all_times), target_dir, "dim_time")
+    return counts
+
+
+def copy_queries(target_dir, s3_prefix, role_s3_read):
+    """
+    :param target_dir: the output directory, uploaded below `s3_prefix`
+    :param s3_prefix: the s3 location the output directory is uploaded to
+    :param role_s3_read: the s3 role with read access
+    :return: the COPY statements that load the written tables
+    """
+    queries = []
+    for table in star_schema:
+        path = f"{s3_prefix.rstrip('/')}/{table_path(target_dir, table).replace(os.sep, '/')}"
+        queries.append(final_table_copy_queries[table].replace("$path", path).replace("$iam", role_s3_read))
+    return queries
+
+
+def parse_arguments():
+    """
+    Parse the command line options of the local transform.
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Build the star schema from the combined files with pandas.")
+    parser.add_argument("--events", default="events.json", help="combined log events (default: events.json)")
+    parser.add_argument("--songs", default="songs.json", help="combined songs (default: songs.json)")
+    parser.add_argument("--output", default="transformed",
+                        help="directory the gzip CSV file of every table is written to (default: transformed)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help=f"number of events transformed at once (default: {BATCH_SIZE})")
+    parser.add_argument("--s3-prefix", default="s3://<BUCKET>/<PATH>",
+                        help="s3 location the output directory is uploaded to, used in the printed COPY statements")
+    parser.add_argument("--exact-match", action="store_true",
+                        help="match the songplays only by exact title and artist, like the warehouse")
+    parser.add_argument("--song-index", default=None,
+                        help="the cached index of the songs, rebuilt when the songs changed "
+                             "(default: next to the songs, like songs.index.pickle)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    start = time.perf_counter()
+    song_index = None if args.exact_match else load_song_index(args.songs, args.song_index)
+    counts = transform(args.events, args.songs, args.output, args.batch_size, song_index)
+    for table, count in counts.items():
+        print(f"-- {count} rows of {table} written to {table_path(args.output, table)}")
+    print(f"-- finished in {time.perf_counter() - start:.3f}s")
+
+    role_s3_read = config.get("CLUSTER", "role_s3_read", fallback="<ROLE_S3_READ>")
+    for query in copy_queries(args.output, args.s3_prefix, role_s3_read):
+        print(query)
+
+
+if __name__ == "__main__":
+    main()